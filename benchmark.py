@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import struct
+import collections
+
+# run headless
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+# only the serial code is imported up front, so the slip group runs without
+# pygame or a display, everything else is imported by the groups using it
+import tracker
+
+MATRIX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'homography.npy')
+
+# name -> seconds per operation, in the order they ran
+results = collections.OrderedDict()
+
+class NullSerial(object):
+    """Stands in for serial.Serial so a Tracker can run without hardware"""
+
+    def __init__(self, stream=''):
+        self.stream = stream
+        self.position = 0
+        self.timeout = 0
+
+    def flushInput(self):
+        pass
+
+    def read(self, size):
+        # replay the stream over and over
+        if len(self.stream) == 0:
+            return ''
+        if self.position >= len(self.stream):
+            self.position = 0
+        data = self.stream[self.position:self.position+size]
+        self.position += size
+        return data
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+class SyntheticCamera(object):
+    """Stands in for pygame.camera.Camera, cycling through some frames"""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def get_size(self):
+        return self.frames[0].get_size()
+
+    def get_image(self, surface=None):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        if surface is None:
+            return frame.copy()
+        surface.blit(frame, (0, 0))
+        return surface
+
+class FakeBlob(object):
+    """A round blob with the same methods as a pygame.mask.Mask component"""
+
+    def __init__(self, center, radius, points):
+        self.center = center
+        self.radius = radius
+        angles = [2*math.pi*i/points for i in range(0, points)]
+        self.points = [(int(center[0] + radius*math.cos(a)), int(center[1] + radius*math.sin(a))) for a in angles]
+
+    def count(self):
+        return int(math.pi*self.radius**2)
+
+    def centroid(self):
+        return self.center
+
+    def outline(self, every=1):
+        return self.points[::every]
+
+    def get_bounding_rects(self):
+        import pygame
+        r = self.radius
+        return [pygame.Rect(self.center[0]-r, self.center[1]-r, r*2+1, r*2+1)]
+
+def best_time(func, repeat=5):
+    # best of a few runs, to keep scheduler noise out of the result
+    best = None
+    for i in range(0, repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def bench(name, func, count=1, repeat=5):
+    # time count operations done by func, and record the time per operation
+    elapsed = best_time(func, repeat)/count
+    results[name] = elapsed
+    print '  %-40s %12.3f us' % (name, elapsed*1e6)
+    return elapsed
+
+def slip_stream(t, count):
+    # the mix you get with quat, acc, gyro and mag all streaming
+    random.seed(0)
+    packets = []
+    for i in range(0, count):
+        kind = i % 4
+        if kind == 0:
+            packed = struct.pack('!Bffff', tracker.PACKET_QUAT, random.random(),
+                                 random.random(), random.random(), random.random())
+        else:
+            packed = struct.pack('!Bhhh', kind, random.randint(-32768, 32767),
+                                 random.randint(-32768, 32767), random.randint(-32768, 32767))
+        packets.append(t.encode(packed))
+    return ''.join(packets)
+
+def bench_slip(count=20000, chunk=1024):
+    print 'SLIP codec, per packet'
+    t = tracker.Tracker(None, ser=NullSerial())
+    stream = slip_stream(t, count)
+    chunks = [stream[i:i+chunk] for i in range(0, len(stream), chunk)]
+
+    def run(decode):
+        for c in chunks:
+            decode(c)
+
+    bench('slip.decode_chars', lambda: run(t.decode_chars), count)
+    bench('slip.decode', lambda: run(t.decode), count)
+
+    # read_packets pulling the same stream through a serial stand-in
+    reader = tracker.Tracker(None, ser=NullSerial(stream))
+    reads = len(chunks)
+
+    def read():
+        for i in range(0, reads):
+            reader.read_packets()
+
+    bench('slip.read_packets', read, count)
+
+    def write():
+        for i in range(0, count):
+            t.set_color((i & 0xff, 0xc0, 0xdb))
+
+    bench('slip.write_packet', write, count)
+
+def synthetic_frames(resolution=(640, 480), count=10):
+    # four canvas corners and a spray can, each a soft bright dot on a noisy background
+    import pygame
+    random.seed(0)
+    frames = []
+    for i in range(0, count):
+        frame = pygame.surface.Surface(resolution, 0, 24)
+        frame.fill((20, 20, 20))
+        for j in range(0, 200):
+            frame.set_at((random.randrange(resolution[0]), random.randrange(resolution[1])), (255, 255, 255))
+        dots = [(40, 40), (resolution[0]-40, 40), (40, resolution[1]-40), (resolution[0]-40, resolution[1]-40),
+                (random.randrange(80, resolution[0]-80), random.randrange(80, resolution[1]-80))]
+        for dot in dots:
+            pygame.draw.circle(frame, (180, 180, 180), dot, 14)
+            pygame.draw.circle(frame, (255, 255, 255), dot, 10)
+        frames.append(frame)
+    return frames
+
+def bench_blobs(frames, threshold=100):
+    import pygame
+    import blobs
+    print 'Blob detection, per %dx%d frame' % frames[0].get_size()
+    for backend in ('pygame', 'numpy'):
+        if backend == 'numpy' and not blobs.LABEL_SUPPORT:
+            print '  %-40s skipped, needs scipy' % ('blobs.' + backend)
+            continue
+        detector = blobs.get_detector(backend)
+
+        def run():
+            for frame in frames:
+                for blob in detector.detect(frame, threshold):
+                    blob.centroid()
+                    blob.outline(1)
+
+        bench('blobs.' + backend, run, len(frames))
+
+    for factor in (2, 4):
+        detector = blobs.get_detector('pygame', factor)
+
+        def decimated():
+            for frame in frames:
+                for blob in detector.detect(frame, threshold):
+                    blob.centroid()
+                    blob.outline(1)
+
+        elapsed = bench('blobs.decimated.%d' % factor, decimated, len(frames))
+        if elapsed >= results['blobs.pygame']:
+            print '    not faster than full resolution here, leave --decimate off'
+
+    segmenter = blobs.AdaptiveThreshold(frames[0].get_size())
+    detector = blobs.get_detector('pygame')
+    # a dark frame too, like the camera gives with nothing in view
+    dark = pygame.surface.Surface(frames[0].get_size(), 0, 24)
+    dark.fill((0, 0, 0))
+
+    def adaptive():
+        for frame in frames + [dark]:
+            foreground, level = segmenter.segment(frame)
+            detector.detect(foreground, level)
+
+    bench('blobs.adaptive', adaptive, len(frames) + 1)
+
+def bench_homography(counts=(4, 16, 64, 256)):
+    import numpy
+    import homography
+    print 'Homography estimation, per calculate()'
+    random.seed(0)
+    m = numpy.load(MATRIX_FILE)
+    for n in counts:
+        for name, algorithm in (('perspective', homography.PerspectiveTransform),
+                                ('leastsquares', homography.LeastSquaresTransform)):
+            transform = algorithm((848, 480))
+            transform.points = n
+            for i in range(0, n):
+                camera = (random.uniform(0, 640), random.uniform(0, 480))
+                c = numpy.dot(m, [camera[0], camera[1], 1])
+                transform.display_points.append((c[0]/c[2], c[1]/c[2]))
+                transform.camera_points.append(camera)
+            bench('homography.%s.%d' % (name, n), transform.calculate, 1, 20)
+
+def make_canvas(frames, display_res=(848, 480)):
+    import numpy
+    import canvas
+    matrix = numpy.load(MATRIX_FILE)
+    return canvas.AdjacentCanvas(matrix, None, None, camera=SyntheticCamera(frames),
+                                 ser=NullSerial(), display_res=display_res)
+
+def bench_tracking(frames, sizes=(50, 200, 1000)):
+    import brush
+    print 'Tracking, per call'
+    c = make_canvas(frames)
+
+    def convert():
+        for i in range(0, 1000):
+            c.convert_point((320, 240))
+
+    bench('canvas.convert_point', convert, 1000)
+
+    for n in sizes:
+        blob = FakeBlob((320, 240), 20, n)
+        bench('canvas.points_from_blob.%d' % n, lambda: c.points_from_blob(blob, c.spray_sizes), 1, 20)
+
+    corners = [FakeBlob(p, 10, 60) for p in ((40, 40), (600, 40), (40, 440), (600, 440))]
+    bench('canvas.update_tracking.corners', lambda: c.update_tracking(corners), 1, 20)
+    # a canvas being carried around, so every frame redraws the quad
+    step = [0]
+    shifted = [[FakeBlob((p[0] + dx, p[1] + dy), 10, 60) for p in ((40, 40), (600, 40), (40, 440), (600, 440))]
+               for dx, dy in ((0, 0), (8, 0), (8, 8), (0, 8))]
+
+    def moving():
+        step[0] += 1
+        c.update_tracking(shifted[step[0] % len(shifted)])
+
+    bench('canvas.update_tracking.corners.moving', moving, 1, 20)
+    spray = [FakeBlob((320, 240), 20, 200)]
+    bench('canvas.update_tracking.spray', lambda: c.update_tracking(spray), 1, 20)
+    c.brush = brush.BrushCache()
+    bench('canvas.update_tracking.spray.stamp', lambda: c.update_tracking(spray), 1, 20)
+    c.brush = None
+
+    bench('canvas.find_blobs', lambda: c.find_blobs(frames[0]), 1, 20)
+    for can in c.cans:
+        can.close()
+
+def bench_display(frames, resolutions=((848, 480), (1920, 1080))):
+    print 'Display, per frame'
+    for res in resolutions:
+        c = make_canvas(frames, res)
+        name = 'canvas.update_display.%dx%d' % res
+
+        def full():
+            c.full_redraw = True
+            c.update_display()
+
+        bench(name + '.full', full, 1, 20)
+
+        spray = [FakeBlob((320, 240), 20, 200)]
+
+        def spraying():
+            c.update_tracking(spray)
+            c.update_display()
+
+        bench(name + '.spray', spraying, 1, 20)
+        for can in c.cans:
+            can.close()
+
+def compare(old_file):
+    # print how this run compares with an earlier one
+    f = open(old_file)
+    old = json.load(f)
+    f.close()
+    print 'Compared with %s, speedup' % old_file
+    for name, elapsed in results.items():
+        if name in old and old[name] > 0:
+            print '  %-40s %8.2fx' % (name, old[name]/elapsed)
+
+if __name__ == '__main__':
+    # python benchmark.py [--output=file.json] [--compare=file.json] [group...]
+    # groups are slip, blobs, homography, tracking and display, default all
+    # extra arguments are frame images or recorded .frames files to use
+    flags = dict([(a.split('=', 1) + [None])[0:2] for a in sys.argv[1:] if a.startswith('--')])
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    groups = ('slip', 'blobs', 'homography', 'tracking', 'display')
+    selected = [a for a in args if a in groups]
+    if len(selected) == 0:
+        selected = groups
+
+    images = [a for a in args if a not in groups]
+    # only slip runs without frames, and so without pygame
+    frames = None
+    if len([g for g in selected if g != 'slip']):
+        import pygame
+        if len(images):
+            import replay
+            frames = []
+            for image in images:
+                if image.endswith('.frames'):
+                    camera = replay.ReplayCamera(image)
+                    frames += [camera.get_image() for i in range(0, len(camera))]
+                else:
+                    frames.append(pygame.image.load(image))
+        else:
+            frames = synthetic_frames()
+
+    if 'slip' in selected:
+        bench_slip()
+    if 'blobs' in selected:
+        bench_blobs(frames)
+    if 'homography' in selected:
+        bench_homography()
+    if 'tracking' in selected:
+        bench_tracking(frames)
+    if 'display' in selected:
+        bench_display(frames)
+    if frames is not None:
+        pygame.quit()
+
+    if flags.get('--output'):
+        f = open(flags['--output'], 'w')
+        json.dump(results, f, indent=1)
+        f.close()
+    if flags.get('--compare'):
+        compare(flags['--compare'])
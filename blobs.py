@@ -0,0 +1,331 @@
+#!/usr/bin/env python
+
+import heapq
+import numpy
+import pygame
+try:
+    import scipy.ndimage
+    LABEL_SUPPORT = True
+except ImportError:
+    LABEL_SUPPORT = False
+
+class PygameBlobDetector(object):
+    """Finds bright blobs with pygame.mask, the default backend
+
+    detect(surface, threshold, min_size) -- Return the blobs in a surface
+    largest(surface, threshold, min_size) -- Return the largest blob, or None
+
+    Blobs have the same count(), centroid(), outline() and
+    get_bounding_rects() methods as a pygame.mask.Mask.
+    """
+
+    def detect(self, surface, threshold, min_size=100):
+        """Return the blobs in a surface"""
+        mask = pygame.mask.from_threshold(surface, (255, 255, 255), (threshold, threshold, threshold))
+        return mask.connected_components(min_size)
+
+    def largest(self, surface, threshold, min_size=100):
+        """Return the largest blob, or None"""
+        mask = pygame.mask.from_threshold(surface, (255, 255, 255), (threshold, threshold, threshold))
+        cc = mask.connected_component()
+        # assume anything smaller is noise
+        if cc.count() < min_size:
+            return None
+        return cc
+
+class NumpyBlob(object):
+    """A blob found by NumpyBlobDetector, with its data also available as arrays
+
+    area -- Number of pixels in the blob
+    center -- (x, y) centroid as floats
+    edge -- Nx2 array of the blob's boundary pixels, in no particular order
+    """
+
+    def __init__(self, area, center, edge):
+        self.area = area
+        self.center = center
+        self.edge = edge
+        self.ordered = None
+
+    def count(self):
+        return self.area
+
+    def centroid(self):
+        return (self.center[0], self.center[1])
+
+    def outline_array(self):
+        # walk the boundary by angle around the centroid, fine for the
+        # roughly convex blobs an LED makes
+        if self.ordered is None:
+            angles = numpy.arctan2(self.edge[:, 1] - self.center[1], self.edge[:, 0] - self.center[0])
+            self.ordered = self.edge[numpy.argsort(angles)]
+        return self.ordered
+
+    def outline(self, every=1):
+        return [tuple(p) for p in self.outline_array()[::every].tolist()]
+
+    def get_bounding_rects(self):
+        lo = self.edge.min(axis=0)
+        hi = self.edge.max(axis=0)
+        return [pygame.Rect(int(lo[0]), int(lo[1]), int(hi[0]-lo[0])+1, int(hi[1]-lo[1])+1)]
+
+class NumpyBlobDetector(PygameBlobDetector):
+    """Finds bright blobs on a zero-copy array view of the surface
+
+    An alternative to pygame.mask rather than a faster one, since it has to
+    threshold, label and box the whole frame: on the benchmark's 640x480
+    frames it takes 1.0-1.4 times as long as pygame.mask.  What it buys is
+    blobs with their pixels available as arrays.  Needs scipy for the
+    connected component labelling.
+    """
+
+    def __init__(self):
+        # 8-connected, like pygame.mask
+        self.structure = numpy.ones((3, 3), dtype=bool)
+
+    def detect(self, surface, threshold, min_size=100):
+        """Return the blobs in a surface"""
+        # a pixel is lit when every channel is within threshold of white,
+        # the same test pygame.mask.from_threshold does, a channel at a time
+        # since that is several times quicker than all(axis=2)
+        level = 255 - threshold
+        pixels = pygame.surfarray.pixels3d(surface)
+        lit = (pixels[:, :, 0] > level) & (pixels[:, :, 1] > level) & (pixels[:, :, 2] > level)
+        # release the lock on the surface
+        del pixels
+
+        labels, n = scipy.ndimage.label(lit, self.structure)
+        if n == 0:
+            return []
+
+        # only look inside each blob's bounding box, and skip the boxes too
+        # small to hold min_size pixels without looking at all
+        blobs = []
+        for i, box in enumerate(scipy.ndimage.find_objects(labels)):
+            if box is None:
+                continue
+            if (box[0].stop - box[0].start)*(box[1].stop - box[1].start) < min_size:
+                continue
+            mine = labels[box] == i + 1
+            xs, ys = numpy.nonzero(mine)
+            if len(xs) < min_size:
+                continue
+            center = (xs.mean() + box[0].start, ys.mean() + box[1].start)
+            # the boundary is whatever an erosion removes, anything outside
+            # the box is not part of the blob so it erodes the same as the whole frame
+            edge = mine & ~scipy.ndimage.binary_erosion(mine, self.structure)
+            ex, ey = numpy.nonzero(edge)
+            edge_points = numpy.column_stack((ex + box[0].start, ey + box[1].start))
+            blobs.append(NumpyBlob(len(xs), center, edge_points))
+        return blobs
+
+    def largest(self, surface, threshold, min_size=100):
+        """Return the largest blob, or None"""
+        blobs = self.detect(surface, threshold, min_size)
+        if len(blobs) == 0:
+            return None
+        return max(blobs, key=lambda blob:blob.count())
+
+def full_resolution(point, factor):
+    # the centre of the block of full resolution pixels a shrunken one covers
+    return ((point[0] + 0.5)*factor - 0.5, (point[1] + 0.5)*factor - 0.5)
+
+class DecimatedBlob(object):
+    """A blob found in a shrunken frame, in full resolution coordinates"""
+
+    def __init__(self, cc, factor, center):
+        self.cc = cc
+        self.factor = factor
+        self.center = center
+
+    def count(self):
+        return self.cc.count()*self.factor*self.factor
+
+    def centroid(self):
+        return self.center
+
+    def outline(self, every=1):
+        return [full_resolution(p, self.factor) for p in self.cc.outline(every)]
+
+    def get_bounding_rects(self):
+        f = self.factor
+        return [pygame.Rect(r.left*f, r.top*f, r.width*f, r.height*f) for r in self.cc.get_bounding_rects()]
+
+class DecimatedBlobDetector(object):
+    """Finds blobs in a frame shrunk by factor, then refines their centroids
+
+    detect(surface, threshold, min_size) -- Return the blobs in a surface
+    largest(surface, threshold, min_size) -- Return the largest blob, or None
+
+    Thresholding and labelling cost drops with the square of factor, but
+    shrinking the frame still reads one channel of every pixel, so it is
+    only a win where that costs less than thresholding the whole frame.
+    benchmark.py blobs compares the two and says when it is not.  Each
+    centroid is then put back to subpixel accuracy by an intensity weighted
+    mean over a small full resolution window around the blob.
+    """
+
+    def __init__(self, detector, factor=2):
+        self.detector = detector
+        self.factor = factor
+        self.small = None
+        self.blocks = None
+
+    def detect(self, surface, threshold, min_size=100):
+        """Return the blobs in a surface"""
+        f = self.factor
+        pixels = pygame.surfarray.pixels3d(surface)
+        small = self.shrink(pixels)
+        ccs = self.detector.detect(small, threshold, max(min_size/(f*f), 1))
+        if len(ccs) == 0:
+            del pixels
+            return []
+
+        bounds = surface.get_rect()
+        found = []
+        for cc in ccs:
+            # the blob's full resolution footprint, with a little room around it
+            rect = cc.get_bounding_rects()[0]
+            window = pygame.Rect(rect.left*f, rect.top*f, rect.width*f, rect.height*f).inflate(f*2, f*2).clip(bounds)
+            # how far past the threshold each pixel is, the same test the detectors use
+            value = pixels[window.left:window.right, window.top:window.bottom].min(axis=2).astype(float)
+            weights = numpy.clip(value - (255 - threshold), 0, None)
+            total = weights.sum()
+            if total > 0:
+                x = (weights.sum(axis=1)*numpy.arange(window.left, window.right)).sum()/total
+                y = (weights.sum(axis=0)*numpy.arange(window.top, window.bottom)).sum()/total
+                center = (x, y)
+            else:
+                center = full_resolution(cc.centroid(), f)
+            found.append(DecimatedBlob(cc, f, center))
+        del pixels
+        return found
+
+    def largest(self, surface, threshold, min_size=100):
+        """Return the largest blob, or None"""
+        found = self.detect(surface, threshold, min_size)
+        if len(found) == 0:
+            return None
+        return max(found, key=lambda blob:blob.count())
+
+    def shrink(self, pixels):
+        # keep the brightest of each block of factor x factor pixels, so a
+        # single lit pixel is enough to light the block.  The IR frames are
+        # grey, so one channel does for the detectors' darkest channel test,
+        # and a maximum over each of the factor*factor strided slices reads
+        # it only once
+        f = self.factor
+        value = pixels[:, :, 1]
+        w = max(value.shape[0]/f, 1)
+        h = max(value.shape[1]/f, 1)
+        if self.small is None or self.small.get_size() != (w, h):
+            self.small = pygame.surface.Surface((w, h), 0, 24)
+            self.blocks = numpy.empty((w, h), numpy.uint8)
+        self.blocks[...] = value[0:w*f:f, 0:h*f:f]
+        for dx in range(0, f):
+            for dy in range(0, f):
+                block = value[dx:w*f:f, dy:h*f:f]
+                # only short of a full block when the frame is smaller than one
+                if (dx or dy) and block.shape == self.blocks.shape:
+                    numpy.maximum(self.blocks, block, self.blocks)
+        view = pygame.surfarray.pixels3d(self.small)
+        view[...] = self.blocks[:, :, None]
+        del view
+        return self.small
+
+class AdaptiveThreshold(object):
+    """Picks the threshold from the frame itself, after taking out the background
+
+    segment(surface) -- Return a foreground surface and the threshold to find blobs in it with
+    learn(surface) -- Take a frame as the background, e.g. with lamps but no canvas in view
+
+    The foreground is how much brighter each pixel is than the background,
+    as grey, so the detectors can run on it unchanged.  The background
+    follows slow changes in ambient IR where nothing is lit, and the level
+    is recomputed every interval frames, by Otsu's method or as a
+    percentile of the foreground brightness.
+    """
+
+    def __init__(self, resolution, method='otsu', interval=10, rate=0.02, percentile=99.5, min_level=40):
+        self.method = method
+        self.interval = interval
+        self.rate = rate
+        self.percentile = percentile
+        # never go so low that sensor noise counts as lit
+        self.min_level = min_level
+        self.level = 155
+        self.frames = 0
+        self.background = numpy.zeros(resolution, numpy.float32)
+        self.foreground = pygame.surface.Surface(resolution, 0, 24)
+
+    def brightness(self, surface):
+        # lit means every channel is bright, so go by the dimmest
+        pixels = pygame.surfarray.pixels3d(surface)
+        value = pixels.min(axis=2)
+        del pixels
+        return value
+
+    def learn(self, surface):
+        """Take a frame as the background"""
+        self.background[:] = self.brightness(surface)
+
+    def otsu(self, values):
+        # the split that best separates the histogram into two classes, or
+        # None if everything is the same brightness and there is nothing to split
+        hist = numpy.bincount(values.ravel(), minlength=256).astype(float)
+        p = hist/hist.sum()
+        omega = numpy.cumsum(p)
+        mu = numpy.cumsum(p*numpy.arange(256))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            between = (mu[-1]*omega - mu)**2/(omega*(1.0 - omega))
+        if numpy.isnan(between).all():
+            return None
+        return int(numpy.nanargmax(between))
+
+    def segment(self, surface):
+        """Return a foreground surface and the threshold to find blobs in it with"""
+        value = self.brightness(surface)
+        foreground = numpy.clip(value - self.background, 0, 255).astype(numpy.uint8)
+
+        if self.frames % self.interval == 0:
+            if self.method == 'percentile':
+                level = int(numpy.percentile(foreground, self.percentile))
+            else:
+                level = self.otsu(foreground)
+            # keep the last level through a frame with nothing in it
+            if level is not None:
+                self.level = min(max(level, self.min_level), 254)
+        self.frames += 1
+
+        # only learn from the unlit pixels, so the blobs never fade into the background
+        unlit = foreground <= self.level
+        self.background[unlit] += self.rate*(value[unlit] - self.background[unlit])
+
+        pixels = pygame.surfarray.pixels3d(self.foreground)
+        pixels[:] = foreground[:, :, None]
+        del pixels
+        # the detectors call a pixel lit when it is within threshold of white
+        return self.foreground, 255 - self.level
+
+def largest_blobs(ccs, count):
+    """Return the count largest blobs, without sorting the rest"""
+    if len(ccs) <= count:
+        return list(ccs)
+    return heapq.nlargest(count, ccs, key=lambda cc:cc.count())
+
+def get_detector(backend='pygame', decimate=1):
+    """Return a blob detector for the named backend, 'pygame' or 'numpy',
+    working on frames shrunk by decimate if it is more than 1"""
+    detector = None
+    if backend == 'numpy':
+        if LABEL_SUPPORT:
+            detector = NumpyBlobDetector()
+        else:
+            print 'NumPy blob detection requires scipy, using pygame instead'
+    elif backend != 'pygame':
+        print 'Unknown blob detector %s, using pygame instead' % backend
+    if detector is None:
+        detector = PygameBlobDetector()
+    if decimate > 1:
+        detector = DecimatedBlobDetector(detector, decimate)
+    return detector
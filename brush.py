@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import collections
+import numpy
+import pygame
+
+class BrushCache(object):
+    """Soft round spray sprites, rendered once and kept in an LRU cache
+
+    get(radius, alpha, hue) -- Return a sprite, rendering it if needed
+    key(radius, alpha, hue) -- Return the bucketed (radius, alpha, hue) a sprite is kept under
+    stamp(surface, stamps) -- Blit a list of (sprite, center) in one batch, return the rects drawn
+
+    Radius, alpha and hue are bucketed so nearby values share a sprite,
+    and the least recently used sprites are dropped once they take up
+    more than budget bytes.  The hue of a can drifts every frame and its
+    alpha follows the charge, so their buckets have to be coarse for the
+    same sprite to come round again; hits and misses count how well it
+    does.
+    """
+
+    def __init__(self, budget=16*1024*1024, radius_step=2, alpha_step=5, hue_step=15):
+        self.budget = budget
+        self.radius_step = radius_step
+        self.alpha_step = alpha_step
+        self.hue_step = hue_step
+        self.sprites = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, radius, alpha, hue):
+        """Return the bucketed (radius, alpha, hue) a sprite is kept under"""
+        radius = max(int(round(float(radius)/self.radius_step))*self.radius_step, 1)
+        alpha = min(int(round(float(alpha)/self.alpha_step))*self.alpha_step, 255)
+        hue = int(round(float(hue)/self.hue_step))*self.hue_step%360
+        return (radius, alpha, hue)
+
+    def get(self, radius, alpha, hue):
+        """Return a sprite, rendering it if needed"""
+        key = self.key(radius, alpha, hue)
+        sprite = self.sprites.pop(key, None)
+        if sprite is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            sprite = self.render(*key)
+            self.size += sprite.get_width()*sprite.get_height()*4
+            while self.size > self.budget and len(self.sprites):
+                old_key, old = self.sprites.popitem(False)
+                self.size -= old.get_width()*old.get_height()*4
+        # most recently used goes to the end
+        self.sprites[key] = sprite
+        return sprite
+
+    def render(self, radius, alpha, hue):
+        color = pygame.Color(0, 0, 0)
+        color.hsva = (hue, 100, 100, 100)
+        sprite = pygame.surface.Surface((radius*2+1, radius*2+1), pygame.SRCALPHA, 32)
+        sprite.fill((color.r, color.g, color.b, 0))
+
+        # fade the alpha out smoothly towards the edge
+        x, y = numpy.mgrid[-radius:radius+1, -radius:radius+1]
+        d = numpy.sqrt(x**2 + y**2)/radius
+        falloff = numpy.clip(1.0 - d, 0.0, 1.0)**2
+        pixels = pygame.surfarray.pixels_alpha(sprite)
+        pixels[:] = (falloff*alpha).astype(numpy.uint8)
+        del pixels
+        return sprite
+
+    def stamp(self, surface, stamps):
+        """Blit a list of (sprite, center) in one batch, return the rects drawn"""
+        blits = [(sprite, (int(c[0]) - sprite.get_width()/2, int(c[1]) - sprite.get_height()/2))
+                 for sprite, c in stamps]
+        if hasattr(surface, 'blits'):
+            return surface.blits(blits, True)
+        return [surface.blit(sprite, position) for sprite, position in blits]
@@ -1,9 +1,19 @@
 #!/usr/bin/env python
 
+import os
 import sys
-import math
+import time
+import hashlib
 import numpy
+import blobs
+import replay
 import tracker
+import tracking
+import brush
+import store
+import compositor
+import worker
+from profiler import Profiler, NullProfiler
 import pygame
 import pygame.camera
 import pygame.gfxdraw
@@ -13,14 +23,15 @@ import threading
 DEBUG_NONE = 0
 DEBUG_CAMERA = 1
 DEBUG_THRESHOLD = 2
-DEBUG_MAX = 3
+DEBUG_STATS = 3
+DEBUG_MAX = 4
 
 MODE_PAINTING = 0
 MODE_MOVING = 1
 
 class SprayCan(object):
-    def __init__(self, port):
-        self.tracker = tracker.Tracker(port)
+    def __init__(self, port, threaded=False, gain=0.01, threshold=0.005, decay=0.0025, log_interval=None, ser=None):
+        self.tracker = tracker.Tracker(port, threaded, ser=ser)
         self.tracker.set_color((0, 0, 255))
         # IR LED output, button input
         self.tracker.set_gpio_direction(1, 0, 0, 0, 0, 0)
@@ -29,31 +40,69 @@ class SprayCan(object):
         # stream just the GPIO state
         self.tracker.set_streaming_mode(0, 1, 0, 0, 0, 0)
         self.charge = 1.0
+        self.hue = 0.0
+        # the can's blob in the camera, smoothed, and the projector point it was last drawn at
+        self.track = tracking.AlphaBetaFilter()
+        self.last_drawn = None
+        
+        # charge model: how much a shake adds, how hard a shake has to be,
+        # and how much each sprayed frame uses up
+        self.gain = gain
+        self.shake_threshold = threshold
+        self.decay = decay
+        # raw accelerometer reading for 1g
+        self.one_g = 16000.0
+        
+        # optional stats printed at most every log_interval seconds
+        self.log_interval = log_interval
+        self.last_log = time.time()
+        self.samples = 0
+        self.shakes = 0
     
-    def update_shake(self, x, y, z):
-        x = float(x)/1000.0
-        y = float(y)/1000.0
-        z = float(z)/1000.0
-        g = math.fabs(1.0-math.sqrt(x**2+y**2+z**2)/16.0)/100.0
-        if g > 0.005:
-            self.charge += g
-            self.charge = min(self.charge, 1.0)
-        print "g charge %f %f" % (g, self.charge)
+    def update_shake(self, samples):
+        # work on a whole batch of raw (x, y, z) accelerometer samples at once
+        samples = numpy.asarray(samples, dtype=float).reshape(-1, 3)
+        g = numpy.abs(1.0 - numpy.sqrt((samples**2).sum(axis=1))/self.one_g)*self.gain
+        shakes = g[g > self.shake_threshold]
+        self.charge = min(self.charge + shakes.sum(), 1.0)
+        
+        self.samples += len(g)
+        self.shakes += len(shakes)
+        self.log_stats()
+        
+    def log_stats(self):
+        if self.log_interval is None:
+            return
+        now = time.time()
+        if now - self.last_log >= self.log_interval:
+            print "%d accelerometer samples, %d shakes, charge %f" % (self.samples, self.shakes, self.charge)
+            self.last_log = now
+            self.samples = 0
+            self.shakes = 0
     
     def read_packets(self):
         packets = self.tracker.read_packets()
-        for packet in packets:
-            if packet[0] == tracker.PACKET_ACC:
-                self.update_shake(packet[1], packet[2], packet[3])
+        samples = [packet[1:4] for packet in packets if packet[0] == tracker.PACKET_ACC]
+        if len(samples):
+            self.update_shake(samples)
                     
     def set_color(self, color):
-        self.charge -= 0.0025
+        self.charge -= self.decay
         self.charge = max(self.charge, 0.0)
         self.tracker.set_color(color)
         
     def get_charge(self):
         return self.charge
         
+    def lose(self):
+        # stop tracking, so the next stroke starts fresh
+        self.track.reset()
+        self.last_drawn = None
+        
+    def set_ir(self, on):
+        # the IR LED is sunk by the first GPIO, so it is lit when the pin is low
+        self.tracker.set_gpio_value(not on, 1, 0, 0, 0, 0)
+        
     def close(self):
         self.tracker.set_color((64, 0, 0))
         # IR LED output, button input
@@ -62,16 +111,225 @@ class SprayCan(object):
         self.tracker.set_gpio_value(1, 1, 0, 0, 0, 0)
         self.tracker.close()
 
+class Remap(object):
+    """Dense camera to projector lookup table for a fixed homography
+    
+    lookup(point) -- Return the projector point for a camera point
+    lookup_points(points) -- Return projector points for an Nx2 array
+    warp(src, dst) -- Warp a whole camera frame onto a projector surface
+    
+    matrix is the homography the table was built for.  Only whole camera
+    pixels are looked up, subpixel points are projected through it.
+    """
+    
+    def __init__(self, table, display_res, matrix):
+        self.table = table
+        self.matrix = matrix
+        self.size = table.shape[0:2]
+        self.display_res = display_res
+        # precompute which camera pixel each projector pixel shows for warping,
+        # so every projector pixel the camera covers gets filled in
+        u, v = numpy.mgrid[0:display_res[0], 0:display_res[1]]
+        inverse = numpy.linalg.inv(matrix)
+        c = u[:, :, None]*inverse[:, 0] + v[:, :, None]*inverse[:, 1] + inverse[:, 2]
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            x = numpy.rint(c[:, :, 0]/c[:, :, 2])
+            y = numpy.rint(c[:, :, 1]/c[:, :, 2])
+        valid = (x >= 0) & (x < self.size[0]) & (y >= 0) & (y < self.size[1])
+        self.dst = numpy.nonzero(valid)
+        self.src = (x[valid].astype(int), y[valid].astype(int))
+        self.warped = numpy.zeros((display_res[0], display_res[1], 3), numpy.uint8)
+        
+    def lookup(self, point):
+        if point[0] != int(point[0]) or point[1] != int(point[1]):
+            c = project_points(self.matrix, point)[0]
+            return [int(c[0]), int(c[1])]
+        x = min(max(int(point[0]), 0), self.size[0]-1)
+        y = min(max(int(point[1]), 0), self.size[1]-1)
+        return self.table[x, y].tolist()
+        
+    def lookup_points(self, points):
+        points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+        whole = (points == numpy.floor(points)).all(axis=1)
+        result = numpy.empty(points.shape)
+        x = numpy.clip(points[whole, 0].astype(int), 0, self.size[0]-1)
+        y = numpy.clip(points[whole, 1].astype(int), 0, self.size[1]-1)
+        result[whole] = self.table[x, y]
+        if not whole.all():
+            result[~whole] = numpy.trunc(project_points(self.matrix, points[~whole]))
+        return result
+        
+    def warp(self, src, dst):
+        pixels = pygame.surfarray.array3d(src)
+        self.warped[self.dst] = pixels[self.src]
+        pygame.surfarray.blit_array(dst, self.warped)
+        
+def build_remap(matrix, resolution):
+    # project every camera pixel at once, giving a (w x h x 2) table
+    x, y = numpy.mgrid[0:resolution[0], 0:resolution[1]]
+    c = x[:, :, None]*matrix[:, 0] + y[:, :, None]*matrix[:, 1] + matrix[:, 2]
+    table = numpy.trunc(c[:, :, 0:2]/c[:, :, 2:3])
+    table = numpy.clip(table, -32768, 32767)
+    return table.astype(numpy.int16)
+    
+def load_remap(matrix, matrix_file, resolution):
+    # cache the table next to the matrix, keyed on the matrix and resolution
+    key = hashlib.sha1(numpy.ascontiguousarray(matrix, dtype=float).tostring() +
+                       repr(tuple(resolution))).hexdigest()[0:16]
+    cache_file = '%s.%s.remap.npy' % (os.path.splitext(matrix_file)[0], key)
+    if os.path.exists(cache_file):
+        table = numpy.load(cache_file)
+        if table.shape == (resolution[0], resolution[1], 2):
+            return table
+    
+    table = build_remap(matrix, resolution)
+    try:
+        numpy.save(cache_file, table)
+    except IOError as ex:
+        print "Failed to cache lookup table:", ex
+    return table
+
+class LatestQueue(object):
+    """Single slot queue where a new item replaces any unread one
+    
+    put(item) -- Store an item, dropping the previous one if it was unread
+    get(timeout) -- Wait for and return the newest item, or None
+    """
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.item = None
+        self.dropped = 0
+        
+    def put(self, item):
+        self.cond.acquire()
+        if self.item is not None:
+            self.dropped += 1
+        self.item = item
+        self.cond.notify()
+        self.cond.release()
+        
+    def get(self, timeout=None):
+        self.cond.acquire()
+        if self.item is None:
+            self.cond.wait(timeout)
+        item = self.item
+        self.item = None
+        self.cond.release()
+        return item
+
+class OffsetBlob(object):
+    """A connected component found in a window, reported in full frame coordinates"""
+    
+    def __init__(self, cc, offset):
+        self.cc = cc
+        self.offset = offset
+        
+    def count(self):
+        return self.cc.count()
+        
+    def centroid(self):
+        c = self.cc.centroid()
+        return (c[0]+self.offset[0], c[1]+self.offset[1])
+        
+    def outline(self, every=1):
+        return [(p[0]+self.offset[0], p[1]+self.offset[1]) for p in self.cc.outline(every)]
+
+def project_points(matrix, points):
+    # Nx2 camera points through a homography, without rounding
+    points = numpy.asarray(points, dtype=float).reshape(-1, 2)
+    c = numpy.dot(points, matrix[:, 0:2].T) + matrix[:, 2]
+    return c[:, 0:2]/c[:, 2:3]
+
+def points_rect(points):
+    # bounding rectangle of some points, padded to cover the edge pixels
+    points = numpy.asarray(points).reshape(-1, 2)
+    lo = numpy.floor(points.min(axis=0))
+    hi = numpy.ceil(points.max(axis=0))
+    return pygame.Rect(int(lo[0]), int(lo[1]), int(hi[0]-lo[0])+2, int(hi[1]-lo[1])+2)
+
 class AdjacentCanvas(object):
-    def __init__(self, matrix, port1, port2):
+    def __init__(self, matrix, port1, port2, matrix_file=None, threaded=False, roi=False, backend='pygame',
+                 camera=None, ser=None, record=None, profiler=None, display_res=(848, 480),
+                 canvas_file=None, canvas_res=None, process=False, decimate=1):
         self.mat = matrix
         self.debug_mode = DEBUG_NONE
         self.threshold = 100
         self.dthreshold = 0
+        # a blobs.AdaptiveThreshold to pick the threshold itself, or None to use threshold
+        self.segmenter = None
         self.corner_points = []
+        self.corners = tracking.CornerTracker()
+        # the version of the corners last drawn into frame
+        self.frame_version = None
         self.mode = MODE_PAINTING
+        self.detector = blobs.get_detector(backend, decimate)
+        self.profiler = profiler
+        if self.profiler is None:
+            self.profiler = NullProfiler()
+        self.captured_time = None
+        self.font = None
         
-        self.can = SprayCan(port2)
+        # port2 and ser can also be lists, one per spray can, and each can then
+        # gets its own serial threads.  A camera and serial ports can be passed
+        # in, e.g. to replay a recording
+        ports = port2
+        if not isinstance(ports, list):
+            ports = [ports]
+        sers = ser
+        if not isinstance(sers, list):
+            sers = [sers]*len(ports)
+        
+        # start the camera and find its resolution
+        self.resolution = (640, 480)
+        self.camera = camera
+        if self.camera is None:
+            pygame.camera.init()
+            clist = pygame.camera.list_cameras()
+            if len(clist) == 0:
+                raise IOError('No cameras found.  The IRCamera class needs a camera supported by Pygame')
+            self.camera = pygame.camera.Camera(clist[0], self.resolution, "RGB")
+        if record:
+            self.camera = replay.RecordingCamera(self.camera, record + '.frames')
+        self.camera.start()
+        # frames are timed on the camera's clock if it has one, so a replay
+        # tracks and draws the same every time, otherwise on the wall clock
+        self.now = getattr(self.camera, 'now', time.time)
+        # get the actual camera resolution
+        self.resolution = self.camera.get_size()
+        
+        # optionally find the blobs on a process of their own, handing frames
+        # over in shared memory, so tracking isn't competing with drawing for
+        # the GIL.  It is started before pygame and the serial threads, so it
+        # inherits neither
+        self.worker = None
+        if process:
+            self.worker = worker.TrackingProcess(self.resolution, backend, decimate=decimate,
+                                                 max_blobs=4 + len(ports))
+            self.worker.start()
+        
+        self.cans = []
+        for i in range(0, len(ports)):
+            s = sers[i]
+            if record:
+                if s is None:
+                    s = tracker.open_serial(ports[i])
+                s = replay.RecordingSerial(s, replay.packet_log_name(record, i))
+            can = SprayCan(ports[i], threaded or len(ports) > 1, ser=s)
+            # spread the cans' starting colors around the hue circle
+            can.hue = 360.0*i/len(ports)
+            self.cans.append(can)
+        # how far a can's blob may be from where we expected it and still be the same can
+        self.max_jump = 80.0
+        # draw the ink this far ahead of the blob, in seconds, to make up for
+        # the pipeline latency, which is measured if lead is None
+        self.lead = None
+        self.latency = 0.0
+        # longest gap in projector pixels between spray stamps before filling it in
+        self.stroke_spacing = 6.0
+        self.max_stamps = 16
+        # a brush.BrushCache to stamp cached soft sprites, or None to fill the blob outlines
+        self.brush = None
         
 #        self.tracker = tracker.Tracker(port1)
 #        self.tracker.set_color((0, 0, 0))
@@ -82,103 +340,479 @@ class AdjacentCanvas(object):
     
         pygame.init()
         pygame.mouse.set_visible(False)
-        self.display_res = (848, 480)
+        self.display_res = display_res
         self.display = pygame.display.set_mode(self.display_res,pygame.FULLSCREEN)
         self.display.fill((0, 0, 0))
         pygame.display.flip()
         
-        # start the camera and find its resolution
-        pygame.camera.init()
-        clist = pygame.camera.list_cameras()
-        if len(clist) == 0:
-            raise IOError('No cameras found.  The IRCamera class needs a camera supported by Pygame')
-        self.resolution = (640, 480)
-        self.camera = pygame.camera.Camera(clist[0], self.resolution, "RGB")
-        self.camera.start()
-        # get the actual camera resolution
-        self.resolution = self.camera.get_size()
         self.snapshot = pygame.surface.Surface(self.resolution, 0, self.display)
         self.t = pygame.surface.Surface(self.resolution, 0, self.display)
         self.canvas_color = pygame.Color(255,255,255)
         self.spray_sizes = [0.2, 0.3, 0.4]
         self.spray_alphas = [50, 30, 10]
-        self.hue = 0.0
         
-        self.drawing = pygame.surface.Surface(self.display_res, 0, self.display)
+        # the drawing can be bigger than the projector, which then shows the
+        # part of it under the viewport
+        self.canvas_res = self.display_res
+        if canvas_res is not None:
+            self.canvas_res = (max(canvas_res[0], self.display_res[0]), max(canvas_res[1], self.display_res[1]))
+        self.viewport = pygame.Rect((0, 0), self.display_res)
+        self.drawing = pygame.surface.Surface(self.canvas_res, 0, self.display)
         self.frame = pygame.surface.Surface(self.display_res, 0, self.display)
+        # shows the drawing through the canvas in frame, set its half_life to fade the ink
+        self.compositor = compositor.Compositor()
+        
+        # optionally keep the drawing on disk, saving changed tiles every autosave_interval seconds
+        self.store = None
+        self.autosave_interval = 2.0
+        self.last_save = time.time()
+        if canvas_file:
+            self.store = store.TileStore(canvas_file, self.canvas_res)
+            if self.store.load(self.drawing):
+                print "Loaded the canvas from %s" % canvas_file
+        
+        # optionally only search a window around where the spray can should be,
+        # with a full frame scan every roi_full_interval frames to find new blobs
+        self.roi_tracking = roi
+        self.roi_padding = 48
+        self.roi_full_interval = 15
+        self.roi_frames = 0
+        self.roi_center = None
+        self.roi_velocity = (0, 0)
+        
+        # regions changed since the last update_display, and whether to redo everything
+        self.dirty = []
+        self.full_redraw = True
+        self.frame_rect = None
+        
+        # optionally replace the per point projection with a lookup table
+        self.remap = None
+        self.use_remap = bool(matrix_file)
+        self.remap_thread = None
+        # set_matrix and remap_loop hand the rebuild over under this lock
+        self.remap_lock = threading.Lock()
+        self.remap_building = False
+        if matrix_file:
+            self.remap = Remap(load_remap(self.mat, matrix_file, self.resolution), self.display_res, self.mat)
+            self.warped = pygame.surface.Surface(self.display_res, 0, self.display)
+        
+        # optionally keep refining the matrix from the corners while running,
+        # for a canvas and projector that stay put while the camera gets bumped,
+        # see anchor_corners.  A bumped projector can't be seen this way, as
+        # the camera still sees the corners in the same place
+        self.drift_correction = False
+        self.drift = None
+        self.drift_anchors = None
+        # how little the starting matrix is trusted: higher follows a bump
+        # within a few frames, lower takes seconds but shrugs off noisy corners
+        self.drift_confidence = 1.0
+        # how far a corner may wander in camera pixels and still be matched
+        self.drift_radius = 40.0
+        # how far in projector pixels the corners must move to swap in a new matrix
+        self.drift_tolerance = 0.5
+        self.corner_camera = []
+        # when the corners were last seen, and for how long in seconds blobs
+        # where they were are still taken for corners once some go missing
+        self.corner_time = None
+        self.corner_grace = 2.0
+        
+        # optionally grab and segment frames on their own threads, which a
+        # worker process needs too
+        self.threaded = threaded or self.worker is not None
+        self.running = False
+        self.threads = []
+        self.captured = LatestQueue()
+        self.tracked = LatestQueue()
+                
+    def current_remap(self):
+        # a table built for an older matrix is as good as none
+        remap = self.remap
+        if remap is not None and remap.matrix is self.mat:
+            return remap
+        return None
         
     def convert_point(self, point):
+        remap = self.current_remap()
+        if remap is not None:
+            return remap.lookup(point)
         c = numpy.array([point[0],point[1],1])
         c = numpy.dot(self.mat,c)
         return [int(c[0]/c[2]), int(c[1]/c[2])]
         
+    def set_matrix(self, matrix):
+        """Swap in a new camera to projector matrix without stopping"""
+        # the matrix is only ever replaced, never changed in place, so anything
+        # holding the old one still sees a consistent matrix
+        # points are projected directly until a table for the new matrix is ready
+        with self.remap_lock:
+            self.mat = matrix
+            if not self.use_remap or self.remap_building:
+                return
+            self.remap_building = True
+        self.remap_thread = threading.Thread(target=self.remap_loop)
+        self.remap_thread.daemon = True
+        self.remap_thread.start()
+            
+    def remap_loop(self):
+        while True:
+            matrix = self.mat
+            remap = Remap(build_remap(matrix, self.resolution), self.display_res, matrix)
+            # start over if the matrix changed again while building
+            with self.remap_lock:
+                if matrix is self.mat:
+                    self.remap = remap
+                    self.remap_building = False
+                    break
+            
+    def anchor_corners(self):
+        """Remember where the corners are now, to hold them there from now on"""
+        if len(self.corner_camera) < 4:
+            print 'Need to see the 4 corners to anchor them'
+            return
+        camera = numpy.array(self.corner_camera, dtype=float)
+        self.drift_anchors = (camera, project_points(self.mat, camera))
+        self.drift = tracking.HomographyRLS(self.mat, self.resolution, self.display_res,
+                                            confidence=self.drift_confidence)
+        print 'Anchored the corners, correcting drift'
+        
+    def correct_drift(self):
+        # match each anchored corner to the nearest one seen now
+        anchors, targets = self.drift_anchors
+        seen = numpy.array(self.corner_camera, dtype=float)
+        d = ((anchors[:, None, :] - seen[None, :, :])**2).sum(axis=2)
+        nearest = d.argmin(axis=1)
+        matched = d[numpy.arange(len(anchors)), nearest] < self.drift_radius**2
+        if not matched.all() or len(set(nearest.tolist())) < len(anchors):
+            return
+        for i in range(0, len(anchors)):
+            self.drift.update(seen[nearest[i]], targets[i])
+        
+        # only swap when it would visibly move the corners
+        matrix = self.drift.matrix()
+        moved = project_points(matrix, seen) - project_points(self.mat, seen)
+        if numpy.abs(moved).max() > self.drift_tolerance:
+            self.set_matrix(matrix)
+        
+    def convert_points(self, points):
+        # project an Nx2 array of camera points in one go
+        remap = self.current_remap()
+        if remap is not None:
+            return remap.lookup_points(points)
+        return numpy.trunc(project_points(self.mat, points))
+        
     def points_from_blob(self, cc, scalings):
-        drawlists = []
-        # turn the blob into a list of points
-        plist = cc.outline(1)
-        centroid = cc.centroid()
-        c = self.convert_point(centroid)
-        for scale in scalings:
-            drawlist = []
-            for point in plist:
-                norm_point = self.convert_point(point)
-                # scale it bigger or smaller based on the scaling factor
-                scale_point = (c[0]+(norm_point[0]-c[0])*scale,
-                               c[1]+(norm_point[1]-c[1])*scale)
-                drawlist.append(scale_point)
-            drawlists.append(drawlist)
-              
-        return drawlists
-        
-    def update_tracking(self):
-        def triangle_area(a, b, c):
-            return a[0]*b[1] - a[1]*b[0] + b[0]*c[1] - b[1]*c[0] + c[0]*a[1] - c[1]*a[0]
-    
-        # get the individual large blobs inside it
-        ccs = self.mask.connected_components(100)
-        
-        # if we have more than just the 4 corners, find the 4 largest blobs
-        if len(ccs) > 4:
-            ccs = sorted(ccs, key=lambda cc:cc.count(), reverse = True)
-        # get the centers of the points
-        if len(ccs) >= 4:
-            # convert the camera point to a projector point
-            self.corner_points = [self.convert_point(ccs[0].centroid()), self.convert_point(ccs[1].centroid()),\
-                                  self.convert_point(ccs[2].centroid()), self.convert_point(ccs[3].centroid())]
-        
-            # quadrilateral ordering from http://stackoverflow.com/a/246063
-            abc = triangle_area(self.corner_points[0], self.corner_points[1], self.corner_points[2])
-            acd = triangle_area(self.corner_points[0], self.corner_points[2], self.corner_points[3])
+        # turn the blob into an array of projected points
+        plist = self.convert_points(cc.outline(1))
+        c = self.convert_point(cc.centroid())
+        # scale it bigger or smaller based on each scaling factor, giving
+        # a (scales x N x 2) array of rings
+        scales = numpy.asarray(scalings, dtype=float).reshape(-1, 1, 1)
+        return c + (plist - c)*scales
+        
+    def find_blobs_roi(self, snapshot):
+        # predict where the blob is now from where it was and how it was moving
+        p = self.roi_padding
+        x = int(self.roi_center[0] + self.roi_velocity[0])
+        y = int(self.roi_center[1] + self.roi_velocity[1])
+        frame_rect = snapshot.get_rect()
+        rect = pygame.Rect(x-p, y-p, p*2, p*2).clip(frame_rect)
+        if rect.width == 0 or rect.height == 0:
+            return None
+        
+        ccs = self.detector.detect(snapshot.subsurface(rect), self.threshold, 100)
+        if len(ccs) != 1:
+            return None
+        
+        # a blob cut off by the window edge may be bigger than what we see
+        bounds = ccs[0].get_bounding_rects()[0].move(rect.topleft)
+        if (bounds.left == rect.left and rect.left != frame_rect.left) or\
+           (bounds.top == rect.top and rect.top != frame_rect.top) or\
+           (bounds.right == rect.right and rect.right != frame_rect.right) or\
+           (bounds.bottom == rect.bottom and rect.bottom != frame_rect.bottom):
+            return None
+        return [OffsetBlob(ccs[0], rect.topleft)]
+        
+    def update_roi(self, ccs):
+        # only a lone spray blob is followed, anything else means a full scan next time
+        if len(ccs) != 1:
+            self.roi_center = None
+            self.roi_velocity = (0, 0)
+            return
+        c = ccs[0].centroid()
+        if self.roi_center is not None:
+            self.roi_velocity = (c[0]-self.roi_center[0], c[1]-self.roi_center[1])
+        self.roi_center = c
+        
+    def find_blobs(self, snapshot, t=None):
+        # the t key can swap the segmenter out from another thread, so only look once
+        segmenter = self.segmenter
+        if segmenter is not None:
+            # find the blobs in what stands out from the background instead
+            snapshot, self.threshold = segmenter.segment(snapshot)
+        if t is not None:
+            pygame.transform.threshold(t, snapshot, (255, 255, 255), (self.threshold, self.threshold, self.threshold), (0, 0, 0), 1)
+        
+        ccs = None
+        if self.roi_tracking and self.roi_center is not None and self.roi_frames < self.roi_full_interval:
+            ccs = self.find_blobs_roi(snapshot)
+        
+        if ccs is None:
+            self.roi_frames = 0
             
-            if abc < 0:
-                if acd >= 0:
-                    if triangle_area(self.corner_points[0], self.corner_points[1], self.corner_points[3]) < 0:
-                        self.corner_points[2], self.corner_points[3] = self.corner_points[3], self.corner_points[2]
-                    else:
-                        self.corner_points[0], self.corner_points[3] = self.corner_points[3], self.corner_points[0]
-            elif acd < 0:
-                if triangle_area(self.corner_points[0], self.corner_points[1], self.corner_points[3]) < 0:
-                    self.corner_points[1], self.corner_points[2] = self.corner_points[2], self.corner_points[1]
-                else:
-                    self.corner_points[0], self.corner_points[1] = self.corner_points[1], self.corner_points[0]
+            # get the individual large lit blobs
+            ccs = self.detector.detect(snapshot, self.threshold, 100)
+        else:
+            self.roi_frames += 1
+            
+        if self.roi_tracking:
+            self.update_roi(ccs)
+        
+        # anything past the 4 corners and the cans is noise
+        return blobs.largest_blobs(ccs, 4 + len(self.cans))
+        
+    def assign_blobs(self, ccs, t):
+        # each tracked can takes the nearest blob within max_jump of where it
+        # is expected, so the cost grows with the cans, not the pairings.  If
+        # two cans want the same blob the closer one keeps it and the other
+        # looks again among what is left
+        centroids = numpy.array([cc.centroid() for cc in ccs], dtype=float).reshape(-1, 2)
+        free = numpy.ones(len(ccs), dtype=bool)
+        pairs = []
+        waiting = [can for can in self.cans if can.track.active]
+        while len(waiting):
+            claims = {}
+            for can in waiting:
+                d = numpy.sqrt(((centroids - can.track.predict(t))**2).sum(axis=1))
+                d[~free] = numpy.inf
+                j = int(d.argmin()) if len(d) else -1
+                if j < 0 or d[j] > self.max_jump:
+                    can.lose()
+                    continue
+                claims.setdefault(j, []).append((d[j], can))
+            waiting = []
+            for j, wanted in claims.items():
+                wanted.sort(key=lambda w:w[0])
+                pairs.append((wanted[0][1], ccs[j]))
+                free[j] = False
+                waiting += [w[1] for w in wanted[1:]]
+        
+        for can, cc in pairs:
+            can.track.update(cc.centroid(), t)
+        return pairs, [ccs[j] for j in numpy.nonzero(free)[0]]
+        
+    def near_corners(self, ccs, t):
+        # which blobs are where the corners were seen recently, whether or
+        # not the quad is still being tracked
+        if len(self.corner_camera) != 4 or self.corner_time is None or\
+           t - self.corner_time > self.corner_grace or len(ccs) == 0:
+            return numpy.zeros(len(ccs), dtype=bool)
+        last = numpy.array(self.corner_camera, dtype=float)
+        centroids = numpy.array([cc.centroid() for cc in ccs], dtype=float)
+        d = ((centroids[:, None, :] - last[None, :, :])**2).sum(axis=2).min(axis=1)
+        return d <= self.max_jump**2
+        
+    def split_corners(self, ccs, t):
+        # blobs near where the corners were last seen are still the corners
+        near = self.near_corners(ccs, t)
+        corners = [cc for cc, n in zip(ccs, near) if n]
+        rest = [cc for cc, n in zip(ccs, near) if not n]
+        return corners, rest
+        
+    def identify_cans(self, frames=5, settle=0.1, near=10):
+        # light up one can at a time, so we know which blob starts out as which can
+        if len(self.cans) < 2:
+            return
+        for can in self.cans:
+            can.set_ir(False)
+        for can in self.cans:
+            can.tracker.flush()
+        before = numpy.array([cc.centroid() for cc in self.identify_blobs(frames, settle)], dtype=float)
+        for can in self.cans:
+            can.set_ir(True)
+            # the write may still be queued, and the LED takes a moment
+            can.tracker.flush()
+            ccs = self.identify_blobs(frames, settle)
+            # only the blob that wasn't there with every can off is this can
+            new = [cc for cc in ccs if
+                   not len(before) or numpy.sqrt(((before - cc.centroid())**2).sum(axis=1)).min() > near]
+            if len(new) == 1:
+                position = new[0].centroid()
+                can.track.update(position, self.now())
+                print "Found spray can at %s" % repr(position)
             else:
-                self.corner_points[0], self.corner_points[2] = self.corner_points[2], self.corner_points[0]
-                
-            self.frame.fill((0,0,0))
+                print "Couldn't find spray can, %d new blobs" % len(new)
+            can.set_ir(False)
+            can.tracker.flush()
+        # back to the state the cans were set up in
+        for can in self.cans:
+            can.tracker.set_gpio_value(1, 1, 0, 0, 0, 0)
+            
+    def identify_blobs(self, frames, settle):
+        time.sleep(settle)
+        for i in range(0, frames):
+            self.snapshot = self.camera.get_image(self.snapshot)
+        return self.detector.detect(self.snapshot, self.threshold, 100)
+        
+    def spray(self, can, cc, t):
+        start = self.profiler.begin()
+        drawing_points = self.points_from_blob(cc, self.spray_sizes)
+        
+        # move the blob's outline to where the smoothed track says the can
+        # will be by the time this frame is on screen
+        lead = self.lead
+        if lead is None:
+            lead = self.latency
+        center = numpy.array(self.convert_point(cc.centroid()), dtype=float)
+        target = numpy.array(self.convert_point(can.track.predict(t + lead)), dtype=float)
+        drawing_points = drawing_points - center + target
+        
+        # fill in the gap since the last frame, so fast strokes stay solid
+        offsets = [numpy.zeros(2)]
+        if can.last_drawn is not None:
+            gap = target - can.last_drawn
+            stamps = min(int(numpy.hypot(gap[0], gap[1])/self.stroke_spacing), self.max_stamps)
+            offsets = [gap*(float(k)/(stamps+1) - 1.0) for k in range(1, stamps+1)] + offsets
+        can.last_drawn = target
+        start = self.profiler.end('points', start)
+        
+        can.hue += 0.5
+        color = pygame.Color(0,0,0,0)
+        # the drawing is offset by the viewport
+        vp = numpy.array(self.viewport.topleft, dtype=float)
+        stamps = []
+        for i in range(0, len(self.spray_sizes)):
+            color.hsva = (int(can.hue)%360, 100, 100, int(can.get_charge()*self.spray_alphas[i]))
+            if self.brush is not None:
+                # a round sprite the size of the ring, stamped along the stroke
+                radius = numpy.sqrt(((drawing_points[i] - target)**2).sum(axis=1).mean())
+                sprite = self.brush.get(radius, color.a, can.hue)
+                stamps += [(sprite, target + offset + vp) for offset in offsets]
+            else:
+                for offset in offsets:
+                    pygame.gfxdraw.filled_polygon(self.drawing, (drawing_points[i] + offset + vp).tolist(), color)
+        canvas_rect = None
+        if self.brush is not None:
+            # the round sprites can reach well past a long thin outline, so
+            # take what was actually blitted, already on the drawing
+            drawn = [r for r in self.brush.stamp(self.drawing, stamps) if r.width and r.height]
+            if len(drawn):
+                canvas_rect = drawn[0].unionall(drawn[1:])
+        else:
+            rect = points_rect(drawing_points)
+            if len(offsets) > 1:
+                rect.union_ip(points_rect(drawing_points[-1] + offsets[0]))
+            canvas_rect = rect.move(self.viewport.topleft)
+        if canvas_rect is not None:
+            self.dirty.append(canvas_rect.move(-self.viewport.left, -self.viewport.top))
+            # the ink itself changed here, whether or not it is on screen
+            self.compositor.mark(canvas_rect)
+            if self.store is not None:
+                self.store.mark(canvas_rect)
+        self.profiler.end('draw', start)
+        can.set_color((color.r, color.g, color.b))
+        
+    def update_corners(self, ccs, t):
+        self.corner_camera = [cc.centroid() for cc in ccs]
+        self.corner_time = t
+        if self.drift_correction and self.drift_anchors is not None:
+            self.correct_drift()
+        
+        # convert the camera point to a projector point, and only redraw
+        # the canvas if it actually moved
+        points = self.convert_points(self.corner_camera).astype(int).tolist()
+        self.corners.update(points)
+        if self.corners.quad.version != self.frame_version:
+            self.frame_version = self.corners.quad.version
+            self.corner_points = self.corners.quad.points
+            
+            # only clear where the last frame was, and redraw both areas
+            if self.frame_rect is not None:
+                self.frame.fill((0,0,0), self.frame_rect)
+                self.dirty.append(self.frame_rect)
+            else:
+                self.frame.fill((0,0,0))
+                self.full_redraw = True
             if len(self.corner_points) == 4:
                 pygame.gfxdraw.filled_polygon(self.frame, self.corner_points, self.canvas_color)
+                self.frame_rect = points_rect(self.corner_points)
+                self.dirty.append(self.frame_rect)
                 
-        elif len(ccs) == 1:
-            # assume we are in drawing mode if only one point exists
-            drawing_points = self.points_from_blob(ccs[0], self.spray_sizes)
-            self.hue += 0.5
-            color = pygame.Color(0,0,0,0)
-            for i in range(0, len(self.spray_sizes)):
-                print self.can.get_charge()
-                color.hsva = (int(self.hue)%360, 100, 100, int(self.can.get_charge()*self.spray_alphas[i]))
-                pygame.gfxdraw.filled_polygon(self.drawing, drawing_points[i], color)
-            self.can.set_color((color.r, color.g, color.b))
+    def update_tracking(self, ccs):
+        t = self.captured_time
+        if t is None:
+            t = self.now()
+        
+        # tell the cans and the corners apart before picking a mode: blobs
+        # where a tracked can is expected are that can, blobs near the last
+        # corners are corners, and only what is left is up for grabs
+        pairs, rest = self.assign_blobs(ccs, t)
+        corners, rest = self.split_corners(rest, t)
+        
+        if len(corners) + len(rest) >= 4:
+            # the canvas is in view, make up any missing corners from the largest
+            # of the rest
+            corners = blobs.largest_blobs(corners, 4)
+            corners += blobs.largest_blobs(rest, 4 - len(corners))
+            self.update_corners(corners, t)
+        else:
+            # the corners have to be sorted out afresh when they come back
+            self.corners.reset()
+            # anything left over goes to the cans we aren't tracking, in order,
+            # unless there is more of it than cans, so it is likely what is left
+            # of the canvas, or it is where a corner just was
+            lost = [can for can in self.cans if not can.track.active]
+            if len(rest) <= len(lost) and not self.near_corners(rest, t).any():
+                for can, cc in zip(lost, rest):
+                    can.track.update(cc.centroid(), t)
+                    pairs.append((can, cc))
+        
+        for can, cc in pairs:
+            self.spray(can, cc, t)
+            
+    def capture_loop(self):
+        while self.running:
+            # a fresh surface each time, since the other stages may still hold the last one
+            start = self.profiler.begin()
+            snapshot = self.camera.get_image()
+            self.profiler.end('capture', start)
+            if self.worker is not None:
+                self.worker.put(snapshot, self.now())
+                # only kept for the debug overlays
+                self.snapshot = snapshot
+            else:
+                self.captured.put((self.now(), snapshot))
+            
+    def tracking_loop(self):
+        while self.running:
+            item = self.captured.get(0.1)
+            if item is None:
+                continue
+            t = None
+            if self.debug_mode == DEBUG_THRESHOLD:
+                t = pygame.surface.Surface(self.resolution, 0, self.display)
+            start = self.profiler.begin()
+            ccs = self.find_blobs(item[1], t)
+            self.profiler.end('blobs', start)
+            self.tracked.put((item[0], item[1], t, ccs))
+            
+    def start_threads(self):
+        self.running = True
+        self.threads = [threading.Thread(target=self.capture_loop)]
+        # a worker process is already running
+        if self.worker is None:
+            self.threads.append(threading.Thread(target=self.tracking_loop))
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
             
+    def stop_threads(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.worker is not None:
+            self.worker.stop()
+        
     def update_input(self):
     
         # update the threshold but keep it clamped to valid values
@@ -186,39 +820,135 @@ class AdjacentCanvas(object):
         self.threshold = min(self.threshold, 255)
         self.threshold = max(self.threshold, 0)
     
-        self.can.read_packets()
+        start = self.profiler.begin()
+        for can in self.cans:
+            can.read_packets()
+        self.profiler.end('serial', start)
     
-        self.snapshot = self.camera.get_image(self.snapshot)
-        if self.debug_mode == DEBUG_THRESHOLD:
-            pygame.transform.threshold(self.t, self.snapshot, (255, 255, 255), (self.threshold, self.threshold, self.threshold), (0, 0, 0), 1)
-        
-        # get a bitmask of the lit regions
-        self.mask = pygame.mask.from_threshold(self.snapshot, (255, 255, 255), (self.threshold, self.threshold, self.threshold))
+        self.captured_time = None
+        if self.worker is not None:
+            self.worker.threshold.value = self.threshold
+            item = self.worker.get(0.1)
+            if item is None:
+                return
+            self.captured_time = item[0]
+            ccs = item[1]
+            if self.debug_mode == DEBUG_THRESHOLD:
+                pygame.transform.threshold(self.t, self.snapshot, (255, 255, 255), (self.threshold, self.threshold, self.threshold), (0, 0, 0), 1)
+        elif self.threaded:
+            # wait for the newest segmented frame, skipping any we were too slow for
+            item = self.tracked.get(0.1)
+            if item is None:
+                return
+            self.captured_time = item[0]
+            self.snapshot = item[1]
+            if item[2] is not None:
+                self.t = item[2]
+            ccs = item[3]
+        else:
+            start = self.profiler.begin()
+            self.snapshot = self.camera.get_image(self.snapshot)
+            self.profiler.end('capture', start)
+            self.captured_time = self.now()
+            t = None
+            if self.debug_mode == DEBUG_THRESHOLD:
+                t = self.t
+            start = self.profiler.begin()
+            ccs = self.find_blobs(self.snapshot, t)
+            self.profiler.end('blobs', start)
         
-        self.update_tracking()
+        start = self.profiler.begin()
+        self.update_tracking(ccs)
+        self.profiler.end('tracking', start)
         
     def update_display(self):
 #        self.display.fill((0, 0, 0))
-            
-        self.drawing.blit(self.frame, (0, 0), None, BLEND_MIN)
-        self.display.blit(self.drawing, (0, 0))
+        
+        # fade the ink a step where there is any, before working out what to redraw
+        for r in self.compositor.fade(self.drawing, self.now()):
+            self.dirty.append(r.move(-self.viewport.left, -self.viewport.top))
+            if self.store is not None:
+                self.store.mark(r)
+        
+        # the overlays cover most of the screen anyway, so redraw it all for them
+        screen = self.display.get_rect()
+        full = self.full_redraw or self.debug_mode != DEBUG_NONE
+        if full:
+            rects = [screen]
+        else:
+            rects = [r.clip(screen) for r in self.dirty]
+            rects = [r for r in rects if r.width and r.height]
+        self.dirty = []
+        self.full_redraw = False
+        
+        # clip the ink to the canvas and copy it out, only where something changed
+        start = self.profiler.begin()
+        self.compositor.compose(self.display, self.drawing, self.frame, rects, self.viewport.topleft)
+        if self.store is not None and time.time() - self.last_save >= self.autosave_interval:
+            self.store.save(self.drawing)
+            self.last_save = time.time()
 
         # optionally show a debugging overlay on the screen
+        overlay = None
         if self.debug_mode == DEBUG_CAMERA:
-            self.display.blit(self.snapshot, (0, 0))
+            overlay = self.snapshot
         elif self.debug_mode == DEBUG_THRESHOLD:
-            self.display.blit(self.t, (0, 0))
+            overlay = self.t
+        if overlay is not None:
+            # line the camera image up with the projector if we can
+            remap = self.current_remap()
+            if remap is not None:
+                remap.warp(overlay, self.warped)
+                overlay = self.warped
+            self.display.blit(overlay, (0, 0))
+        elif self.debug_mode == DEBUG_STATS:
+            self.draw_stats()
+        self.profiler.end('blit', start)
             
-        pygame.display.flip()
+        start = self.profiler.begin()
+        if full:
+            pygame.display.flip()
+        elif len(rects):
+            pygame.display.update(rects)
+        self.profiler.end('flip', start)
+        # keep a running estimate of how long a frame takes to reach the screen
+        now = self.now()
+        if self.captured_time is not None:
+            self.latency += 0.1*(now - self.captured_time - self.latency)
+        dropped = self.captured.dropped + self.tracked.dropped
+        if self.worker is not None:
+            dropped += self.worker.dropped
+        self.profiler.frame(self.captured_time, dropped, now)
+        
+    def draw_stats(self):
+        if self.profiler.enabled:
+            lines = self.profiler.summary()
+        else:
+            lines = ['Profiling is off, run with --profile']
+        if self.font is None:
+            pygame.font.init()
+            self.font = pygame.font.Font(None, 24)
+        y = 10
+        for line in lines:
+            text = self.font.render(line, True, (0, 255, 0), (0, 0, 0))
+            self.display.blit(text, (10, y))
+            y += text.get_height()
         
     def run(self):
         going = True
         
+        if self.threaded:
+            self.start_threads()
+        
         while going:
             self.update_input()
         
             self.update_display()
             
+            # a replayed recording ends the run when it runs out of frames
+            if getattr(self.camera, 'finished', False):
+                going = False
+            
 #            print self.tracker.read_packet()
             
             events = pygame.event.get()
@@ -231,11 +961,35 @@ class AdjacentCanvas(object):
                         self.debug_mode += 1
                         if self.debug_mode >= DEBUG_MAX:
                             self.debug_mode = 0
+                        self.full_redraw = True
                         print "Entering debug mode %d" % self.debug_mode
                     elif e.key == K_PLUS or e.key == K_EQUALS:
                         self.dthreshold = 1
                     elif e.key == K_MINUS or e.key == K_UNDERSCORE:
                         self.dthreshold = -1
+                    elif e.key in (K_LEFT, K_RIGHT, K_UP, K_DOWN):
+                        # pan around a canvas bigger than the projector
+                        step = 32
+                        dx = {K_LEFT: -step, K_RIGHT: step}.get(e.key, 0)
+                        dy = {K_UP: -step, K_DOWN: step}.get(e.key, 0)
+                        self.viewport.move_ip(dx, dy)
+                        self.viewport.clamp_ip(pygame.Rect((0, 0), self.canvas_res))
+                        self.full_redraw = True
+                    elif e.key == K_a and self.drift_correction:
+                        self.anchor_corners()
+                    elif e.key == K_t:
+                        # toggle picking the threshold automatically
+                        if self.segmenter is None:
+                            self.segmenter = blobs.AdaptiveThreshold(self.resolution)
+                            print "Picking the threshold automatically"
+                        else:
+                            self.segmenter = None
+                            self.threshold = 100
+                            print "Threshold back to %d" % self.threshold
+                    elif e.key == K_b and self.segmenter is not None:
+                        # whatever is lit now is background, e.g. lamps before the canvas goes up
+                        self.segmenter.learn(self.snapshot)
+                        print "Learned the background"
                 elif e.type == KEYUP:
                     if e.key == K_PLUS or e.key == K_EQUALS or e.key == K_MINUS or e.key == K_UNDERSCORE:
                         self.dthreshold = 0
@@ -245,11 +999,22 @@ class AdjacentCanvas(object):
 #        self.tracker.set_color((64, 64, 0))
 #        self.tracker.set_gpio_value(1, 1, 1, 1, 0, 0)
         
-        self.can.close()
+        if self.threaded:
+            self.stop_threads()
+        self.camera.stop()
+        for can in self.cans:
+            can.close()
+        if self.store is not None:
+            self.store.save(self.drawing)
+            self.store.close()
         pygame.quit()
 
 if __name__ == '__main__':
     matrix_file = 'homography.npy'
+    # pull out the optional flags before the positional arguments,
+    # --name or --name=value
+    flags = dict([(a.split('=', 1) + [None])[0:2] for a in sys.argv if a.startswith('--')])
+    sys.argv = [a for a in sys.argv if not a.startswith('--')]
     port1 = None#'/dev/ttyUSB0'
     port2 = '/dev/ttyUSB0'
     if len(sys.argv) > 2:
@@ -257,8 +1022,62 @@ if __name__ == '__main__':
     if len(sys.argv) > 3:
         port1 = sys.argv[3]
     if len(sys.argv) > 4:
-        port2 = sys.argv[4]
+        # one or more spray can ports, separated by commas
+        port2 = sys.argv[4].split(',')
+
+    # --record=name saves name.frames and name.packets, --replay=name plays
+    # them back instead of using the hardware, --fast as quickly as possible
+    camera = None
+    ser = None
+    if flags.get('--replay'):
+        clock = replay.ReplayClock('--fast' not in flags)
+        camera = replay.ReplayCamera(flags['--replay'] + '.frames', clock)
+        cans = 1
+        if isinstance(port2, list):
+            cans = len(port2)
+        ser = [replay.ReplaySerial(replay.packet_log_name(flags['--replay'], i), clock) for i in range(0, cans)]
+
+    # --profile collects per stage timings, --trace=file.json or file.csv saves them
+    prof = None
+    if '--profile' in flags or flags.get('--trace'):
+        prof = Profiler()
 
     matrix = numpy.load(matrix_file)
-    c = AdjacentCanvas(matrix, port1, port2)
+    remap_file = None
+    backend = 'pygame'
+    if '--numpy' in flags:
+        backend = 'numpy'
+    if '--remap' in flags:
+        remap_file = matrix_file
+    # --canvas=file.npy keeps the drawing between runs, --canvas-size=WxH
+    # makes it bigger than the projector
+    canvas_res = None
+    if flags.get('--canvas-size'):
+        canvas_res = tuple([int(v) for v in flags['--canvas-size'].split('x')])
+    # --process finds the blobs on a separate process instead of a thread,
+    # --decimate=N finds them in frames shrunk N times, then refines the centroids,
+    # which is only faster where benchmark.py blobs says so
+    c = AdjacentCanvas(matrix, port1, port2, remap_file, '--threaded' in flags, '--roi' in flags, backend,
+                       camera, ser, flags.get('--record'), prof, canvas_file=flags.get('--canvas'),
+                       canvas_res=canvas_res, process='--process' in flags,
+                       decimate=int(flags.get('--decimate') or 1))
+    # --drift keeps correcting the matrix once a is pressed with the canvas in place
+    c.drift_correction = '--drift' in flags
+    # --drift-confidence=c trades how quickly it follows a bump against noise
+    if flags.get('--drift-confidence'):
+        c.drift_confidence = float(flags['--drift-confidence'])
+    # --auto-threshold picks the threshold from a histogram after taking out the background
+    if '--auto-threshold' in flags:
+        c.segmenter = blobs.AdaptiveThreshold(c.resolution)
+    # --fade=seconds fades the ink away with that half life
+    if flags.get('--fade'):
+        c.compositor.half_life = float(flags['--fade'])
+    # --stamp draws with cached soft sprites instead of the blob outlines
+    if '--stamp' in flags:
+        c.brush = brush.BrushCache()
+    # --identify blinks each can in turn to tell them apart at the start
+    if '--identify' in flags:
+        c.identify_cans()
     c.run()
+    if flags.get('--trace'):
+        prof.save(flags['--trace'])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import math
+import pygame
+from pygame.locals import *
+
+class Compositor(object):
+    """Shows the ink through the canvas mask, without changing either
+
+    compose(display, ink, mask, rects, offset) -- Copy the masked ink into rects of the display
+    mark(rect) -- Note that ink was added, so it gets faded
+    fade(ink, now) -- Darken the inked tiles a step, return the rects it changed
+
+    The ink is only ever clipped on its way to the display, so ink outside
+    a moving canvas comes back when the canvas does.  With a half_life
+    in seconds, ink fades away over time, a tile at a time, and tiles are
+    forgotten once they have faded to black.
+    """
+
+    def __init__(self, half_life=None, tile_size=64, interval=0.25):
+        self.half_life = half_life
+        self.tile_size = tile_size
+        self.interval = interval
+        # tile -> how bright its ink can still be at most
+        self.inked = {}
+        self.last_fade = None
+
+    def compose(self, display, ink, mask, rects, offset=(0, 0)):
+        """Copy the masked ink into rects of the display
+
+        rects are in display coordinates, and the ink is offset from them
+        by offset.  The mask is the same size as the display.
+        """
+        for r in rects:
+            display.blit(ink, r, r.move(offset))
+            display.blit(mask, r, r, BLEND_MIN)
+
+    def mark(self, rect):
+        """Note that ink was added, so it gets faded"""
+        if self.half_life is None or rect.width <= 0 or rect.height <= 0:
+            return
+        s = self.tile_size
+        for tx in range(max(rect.left, 0)/s, max(rect.right-1, 0)/s + 1):
+            for ty in range(max(rect.top, 0)/s, max(rect.bottom-1, 0)/s + 1):
+                self.inked[(tx, ty)] = 255.0
+
+    def fade(self, ink, now):
+        """Darken the inked tiles a step, return the rects it changed"""
+        if self.half_life is None:
+            return []
+        if self.last_fade is None:
+            self.last_fade = now
+        elapsed = now - self.last_fade
+        if elapsed < self.interval:
+            return []
+        # keep the clock moving while there is no ink, or the first fade
+        # after a quiet spell would take all of it out on the new ink
+        self.last_fade = now
+        if len(self.inked) == 0:
+            return []
+
+        # BLEND_MULT rounds (ink*k)/256 down in some pygame versions and up in
+        # others, so dim ink could stop fading altogether.  Taking off a level
+        # more every step makes sure every lit channel drops
+        k = int(256*math.pow(0.5, elapsed/self.half_life))
+        k = min(max(k, 0), 255)
+        s = self.tile_size
+        bounds = ink.get_rect()
+        rects = []
+        faded = []
+        for tile, brightness in self.inked.items():
+            rect = pygame.Rect(tile[0]*s, tile[1]*s, s, s).clip(bounds)
+            ink.fill((k, k, k), rect, BLEND_MULT)
+            ink.fill((1, 1, 1), rect, BLEND_SUB)
+            rects.append(rect)
+            # still an upper bound on the brightest channel either way
+            brightness = min(brightness*k/256, brightness - 1)
+            self.inked[tile] = brightness
+            if brightness < 1:
+                faded.append((tile, rect))
+
+        # only forget a tile once it really is black
+        if len(faded):
+            pixels = pygame.surfarray.pixels3d(ink)
+            for tile, rect in faded:
+                lit = int(pixels[rect.left:rect.right, rect.top:rect.bottom].max())
+                if lit == 0:
+                    del self.inked[tile]
+                else:
+                    self.inked[tile] = float(lit)
+            del pixels
+        return rects
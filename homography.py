@@ -22,10 +22,12 @@ split into classes with the intent of being easy to pull apart and use
 elsewhere.
 
 FakeSource - A fake camera for testing purposes
+SyntheticSource - A fake camera that sees the display through a known homography
 IRCamera - Finds points using a pygame-supported IR Camera
 WiiRemote - Finds points using a Wii Remote (unfinished)
 PerspectiveTransform - Calculates a homography using four corner points
 LeastSquaresTransform - Calculates a homography using four or more random points
+PatternCalibration - Matches a projected grid of dots to find many points at once
 Homography - Uses pygame to interactively calculate a camera-projector homography 
 """
 
@@ -34,12 +36,14 @@ __author__ = 'Nirav Patel'
 
 #!/usr/bin/env python
 
+import os
 import sys
 import random
 import getopt
 import numpy
 from numpy import linalg
 import pygame
+import blobs
 try:
     import pygame.camera
     CAMERA_SUPPORT = True
@@ -68,6 +72,44 @@ class FakeSource:
         self.count += 1
         return ret
 
+class SyntheticSource(FakeSource):
+    """A fake camera looking at the display through a known homography
+    
+    matrix -- The camera to display homography to simulate
+    
+    Lets calibration run headless, and shows how close it gets to the
+    real matrix.
+    """
+    
+    def __init__(self, matrix, resolution=(640,480)):
+        FakeSource.__init__(self)
+        self.matrix = matrix
+        self.resolution = resolution
+        self.snapshot = pygame.surface.Surface(self.resolution, 0, 24)
+        self.map = None
+        
+    def update(self):
+        """Return what the camera would see of the display"""
+        display = pygame.display.get_surface()
+        if self.map is None:
+            # where every camera pixel lands on the display, worked out once
+            x, y = numpy.mgrid[0:self.resolution[0], 0:self.resolution[1]]
+            p = numpy.dot(self.matrix, [x.ravel(), y.ravel(), numpy.ones(x.size)])
+            dx = numpy.round(p[0]/p[2]).astype(int)
+            dy = numpy.round(p[1]/p[2]).astype(int)
+            w, h = display.get_size()
+            inside = (dx >= 0) & (dx < w) & (dy >= 0) & (dy < h)
+            self.map = (numpy.where(inside, dx, 0).reshape(x.shape),
+                        numpy.where(inside, dy, 0).reshape(x.shape),
+                        inside.reshape(x.shape))
+        
+        dx, dy, inside = self.map
+        # a copy rather than a view, since a headless display may be 8 bit
+        pixels = pygame.surfarray.array3d(display)
+        frame = pixels[dx, dy]*inside[:, :, None]
+        pygame.surfarray.blit_array(self.snapshot, frame)
+        return self.snapshot
+        
 class IRCamera(FakeSource):
     """Interface an IR Camera in pygame
     
@@ -75,9 +117,13 @@ class IRCamera(FakeSource):
     get_point() -- Return the centroid of the largest IR blob found
     """
     
-    def __init__(self):
+    def __init__(self, detector=None):
         pygame.camera.init()
         
+        self.detector = detector
+        if self.detector is None:
+            self.detector = blobs.PygameBlobDetector()
+        
         # start the camera and find its resolution
         clist = pygame.camera.list_cameras()
         if len(clist) == 0:
@@ -96,10 +142,9 @@ class IRCamera(FakeSource):
         
     def get_point(self):
         """Return the centroid of the largest IR blob found"""
-        mask = pygame.mask.from_threshold(self.snapshot, (255,255,255), (50,50,50))
-        cc = mask.connected_component()
         # find the center of the dot, assuming its big enough to not be noise
-        if cc.count() < 100:
+        cc = self.detector.largest(self.snapshot, 50, 100)
+        if cc is None:
             return None
         centroid = cc.centroid()
         return centroid
@@ -117,6 +162,74 @@ class WiiRemote(FakeSource):
     def get_point(self):
         pass
 
+def normalize_points(points):
+    """Returns the points moved to the origin and scaled to an average
+    distance of sqrt(2) from it, and the 3x3 matrix that does it"""
+    center = points.mean(axis=0)
+    distance = numpy.sqrt(((points - center)**2).sum(axis=1)).mean()
+    scale = 1.0
+    if distance > 0:
+        scale = numpy.sqrt(2)/distance
+    T = numpy.array([[scale, 0, -scale*center[0]],
+                     [0, scale, -scale*center[1]],
+                     [0, 0, 1]])
+    return (points - center)*scale, T
+
+def solve_dlt(camera, display):
+    """Returns the homography mapping Nx2 camera points onto display points,
+    using the normalized direct linear transform"""
+    # Hartley normalization keeps the system well conditioned, see
+    # Hartley and Zisserman, Multiple View Geometry, section 4.4
+    c, Tc = normalize_points(camera)
+    d, Td = normalize_points(display)
+    n = len(c)
+    
+    # two rows per point pair, built for all the points at once
+    A = numpy.zeros((n*2, 9))
+    A[0::2, 0:2] = -c
+    A[0::2, 2] = -1
+    A[0::2, 6:8] = c*d[:, 0:1]
+    A[0::2, 8] = d[:, 0]
+    A[1::2, 3:5] = -c
+    A[1::2, 5] = -1
+    A[1::2, 6:8] = c*d[:, 1:2]
+    A[1::2, 8] = d[:, 1]
+    # with only 4 pairs, pad to a square system so the thin SVD below
+    # still has the null space in it
+    if len(A) < 9:
+        A = numpy.vstack((A, numpy.zeros((9 - len(A), 9))))
+    
+    # the solution is the singular vector with the smallest singular value
+    U, S, Vt = linalg.svd(A, full_matrices=False)
+    H = numpy.dot(linalg.inv(Td), numpy.dot(Vt[-1].reshape(3, 3), Tc))
+    return H/H[2, 2]
+
+def reprojection_errors(homography, camera, display):
+    """Returns how far each camera point lands from its display point"""
+    p = numpy.dot(camera, homography[0:2, 0:2].T) + homography[0:2, 2]
+    w = numpy.dot(camera, homography[2, 0:2]) + homography[2, 2]
+    return numpy.sqrt(((p/w[:, None] - display)**2).sum(axis=1))
+
+def ransac(camera, display, threshold=3.0, iterations=500):
+    """Returns the homography fitting the most point pairs to within
+    threshold pixels, refit on those pairs, and a mask of them"""
+    n = len(camera)
+    best = None
+    for i in range(0, iterations):
+        sample = random.sample(range(0, n), 4)
+        try:
+            H = solve_dlt(camera[sample], display[sample])
+        except linalg.LinAlgError:
+            continue
+        inliers = reprojection_errors(H, camera, display) < threshold
+        if best is None or inliers.sum() > best.sum():
+            best = inliers
+            if best.all():
+                break
+    if best is None or best.sum() < 4:
+        best = numpy.ones(n, dtype=bool)
+    return solve_dlt(camera[best], display[best]), best
+
 class PerspectiveTransform:
     """Calculates the perspective transform using 4 corner points
     
@@ -165,30 +278,32 @@ class PerspectiveTransform:
             print 'Need 4 points to calculate transform'
             return None
         
-        # This calculation is from the paper, A Plane Measuring Device
-        # by A. Criminisi, I. Reid, A. Zisserman.  For more details, see:
-        # http://www.robots.ox.ac.uk/~vgg/presentations/bmvc97/criminispaper/
-        A = numpy.zeros((n*2,8))
-        B = numpy.zeros((n*2,1))
-        for i in range(0,n):
-            A[2*i][0:2] = self.camera_points[i]
-            A[2*i][2] = 1
-            A[2*i][6] = -self.camera_points[i][0]*self.display_points[i][0]
-            A[2*i][7] = -self.camera_points[i][1]*self.display_points[i][0]
-            A[2*i+1][3:5] = self.camera_points[i]
-            A[2*i+1][5] = 1
-            A[2*i+1][6] = -self.camera_points[i][0]*self.display_points[i][1]
-            A[2*i+1][7] = -self.camera_points[i][1]*self.display_points[i][1]
-            B[2*i] = self.display_points[i][0]
-            B[2*i+1] = self.display_points[i][1]
-        
-        X = linalg.lstsq(A,B)
-        return numpy.reshape(numpy.vstack((X[0],[1])),(3,3))
+        return self.fit(numpy.array(self.camera_points, dtype=float),
+                        numpy.array(self.display_points, dtype=float))
+        
+    def fit(self, camera, display):
+        """Solves for the homography and measures how well it fits"""
+        homography = solve_dlt(camera, display)
+        self.measure(homography, camera, display)
+        return homography
+        
+    def measure(self, homography, camera, display):
+        self.errors = reprojection_errors(homography, camera, display)
+        self.error = numpy.sqrt(numpy.mean(self.errors**2))
     
 class LeastSquaresTransform(PerspectiveTransform):
     """ Uses 4+ random points in the screen to calculate the transform
+    
+    With ransac set, pairs more than threshold pixels off are left out
+    as outliers, e.g. when a blob was mis-detected.
     """
     
+    def __init__(self, resolution, ransac=False, threshold=3.0):
+        PerspectiveTransform.__init__(self, resolution)
+        self.ransac = ransac
+        self.threshold = threshold
+        self.inliers = None
+    
     def generate_point(self):
         return (random.randint(0,self.resolution[0]), random.randint(0,self.resolution[1]))
         
@@ -198,6 +313,95 @@ class LeastSquaresTransform(PerspectiveTransform):
         
         return len(self.display_points) < self.points
         
+    def fit(self, camera, display):
+        if not self.ransac:
+            return PerspectiveTransform.fit(self, camera, display)
+        # already refit on the inliers
+        homography, self.inliers = ransac(camera, display, self.threshold)
+        self.measure(homography, camera[self.inliers], display[self.inliers])
+        return homography
+        
+class PatternCalibration:
+    """Finds many point pairs at once from a projected grid of dots
+    
+    patterns() -- Return the surfaces to project, in order
+    solve(frames) -- Match the dots in the captured frames and calculate
+    
+    The first pattern lights every dot, so they can all be found in one
+    frame.  Each one after lights the dots whose Gray code has that bit
+    set, so the frames a dot is lit in say which dot it is.  The camera
+    has to be able to see the projector for this, so take any IR filter
+    off while calibrating.
+    """
+    
+    def __init__(self, resolution, algorithm, detector=None, grid=(8,6), radius=8, threshold=100):
+        self.resolution = resolution
+        self.algorithm = algorithm
+        self.detector = detector
+        if self.detector is None:
+            self.detector = blobs.PygameBlobDetector()
+        self.radius = radius
+        self.threshold = threshold
+        
+        # keep the dots well clear of the edges of the display
+        margin = radius*4
+        x, y = numpy.meshgrid(numpy.linspace(margin, resolution[0]-margin, grid[0]),
+                              numpy.linspace(margin, resolution[1]-margin, grid[1]))
+        self.dots = numpy.column_stack((x.ravel(), y.ravel()))
+        n = len(self.dots)
+        self.bits = max(int(numpy.ceil(numpy.log2(n))), 1)
+        index = numpy.arange(n)
+        self.codes = index ^ (index >> 1)
+        
+    def render(self, lit):
+        surface = pygame.surface.Surface(self.resolution, 0, 24)
+        surface.fill((0,0,0))
+        for dot in self.dots[lit]:
+            pygame.draw.circle(surface, (255,255,255), (int(dot[0]), int(dot[1])), self.radius)
+        return surface
+        
+    def patterns(self):
+        """Return the surfaces to project, in order"""
+        patterns = [self.render(numpy.ones(len(self.dots), dtype=bool))]
+        for bit in range(0, self.bits):
+            patterns.append(self.render((self.codes >> bit) & 1 == 1))
+        return patterns
+        
+    def solve(self, frames):
+        """Match the dots in the captured frames and calculate"""
+        found = self.detector.detect(frames[0], self.threshold, self.radius)
+        if len(found) < 4:
+            print 'Only found %d dots, need at least 4' % len(found)
+            return None
+        centers = numpy.array([blob.centroid() for blob in found], dtype=float)
+        cx = numpy.round(centers[:,0]).astype(int)
+        cy = numpy.round(centers[:,1]).astype(int)
+        
+        # read every dot's code from the bit frames at once
+        codes = numpy.zeros(len(centers), dtype=int)
+        for bit, frame in enumerate(frames[1:]):
+            pixels = pygame.surfarray.pixels3d(frame)
+            lit = (pixels[cx, cy] > 255 - self.threshold).all(axis=1)
+            del pixels
+            codes |= lit.astype(int) << bit
+        
+        # Gray code back to the dot index
+        index = codes.copy()
+        shift = 1
+        while shift < self.bits:
+            index ^= index >> shift
+            shift <<= 1
+        
+        # a dot decoded twice is a misread, so leave both out
+        counts = numpy.bincount(index, minlength=len(self.dots))
+        good = (index < len(self.dots))
+        good[good] &= counts[index[good]] == 1
+        print 'Matched %d of %d dots' % (good.sum(), len(self.dots))
+        
+        self.algorithm.display_points += [tuple(p) for p in self.dots[index[good]].tolist()]
+        self.algorithm.camera_points += [tuple(p) for p in centers[good].tolist()]
+        return self.algorithm.calculate()
+        
 class Homography:
     def __init__(self, resolution, algorithm, source):
         pygame.mouse.set_visible(False)
@@ -266,6 +470,31 @@ class Homography:
                             going = False
                         
         homography = self.algorithm.calculate()
+        self.report(homography)
+        return homography
+        
+    def report(self, homography):
+        """Prints how well the homography fits the points it came from"""
+        if homography is None:
+            return
+        inliers = getattr(self.algorithm, 'inliers', None)
+        if inliers is not None:
+            print 'Using %d of %d points, the rest are outliers' % (inliers.sum(), len(inliers))
+        print 'Reprojection error %.3f pixels RMS, %.3f max' % (self.algorithm.error, self.algorithm.errors.max())
+        
+    def run_auto(self, calibration, settle=3):
+        """Projects the calibration patterns and solves from them in one go"""
+        frames = []
+        for pattern in calibration.patterns():
+            self.display.blit(pattern, (0,0))
+            pygame.display.flip()
+            # let the camera catch up with the projector before keeping a frame
+            for i in range(0, settle):
+                self.source.update()
+            frames.append(self.source.update().copy())
+            pygame.event.pump()
+        homography = calibration.solve(frames)
+        self.report(homography)
         return homography
         
 def usage():
@@ -281,6 +510,12 @@ def usage():
     print ' -h or --help            Displays this help text'
     print ' -p or --perspective     Uses the 4 corner points (default)'
     print ' -l or --leastsquares    Uses 4+ random points'
+    print ' -n or --numpy           Finds the IR dot with NumPy instead of pygame.mask'
+    print ' -r or --ransac          Leaves out outlying points in least squares mode'
+    print ' -a or --auto            Calibrates from a projected grid of dots instead,'
+    print '                         the camera has to be able to see the projector'
+    print ' -s or --synthetic=file  Calibrates headless against a simulated camera,'
+    print '                         looking through the homography in file'
     print ''
     print 'Usage:'
     print 'python homography.py matrix_file'
@@ -288,9 +523,13 @@ def usage():
 if __name__ == '__main__':
     matrix_file = 'homography'
     mode = 0
+    backend = 'pygame'
+    use_ransac = False
+    auto = False
+    synthetic = None
     
     try:
-        opts,args = getopt.gnu_getopt(sys.argv[1:], "hpl", ["help", "perspective", "leastsquares"])
+        opts,args = getopt.gnu_getopt(sys.argv[1:], "hplnras:", ["help", "perspective", "leastsquares", "numpy", "ransac", "auto", "synthetic="])
     except getopt.GetoptError, err:
         print str(err)
         usage()
@@ -304,6 +543,16 @@ if __name__ == '__main__':
             mode = 0
         elif o in ("-l", "--leastsquares"):
             mode = 1
+        elif o in ("-n", "--numpy"):
+            backend = 'numpy'
+        elif o in ("-r", "--ransac"):
+            use_ransac = True
+        elif o in ("-a", "--auto"):
+            auto = True
+        elif o in ("-s", "--synthetic"):
+            synthetic = numpy.load(a)
+            auto = True
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
     
     if len(args) > 0:
         matrix_file = args[0]
@@ -316,16 +565,24 @@ if __name__ == '__main__':
     if mode == 0:
         algo = PerspectiveTransform(resolution)
     elif mode == 1:
-        algo = LeastSquaresTransform(resolution)
+        algo = LeastSquaresTransform(resolution, use_ransac)
     
 #    source = FakeSource()
-    if CAMERA_SUPPORT:
-        source = IRCamera()
+    source = None
+    if synthetic is not None:
+        source = SyntheticSource(synthetic)
+    elif CAMERA_SUPPORT:
+        source = IRCamera(blobs.get_detector(backend))
         
     if source:
         hom = Homography(resolution, algo, source)
-        m = hom.run()
-        if m != None:
+        if auto:
+            m = hom.run_auto(PatternCalibration(resolution, algo, blobs.get_detector(backend)))
+        else:
+            m = hom.run()
+        if m is not None and synthetic is not None:
+            print 'Largest difference from the simulated matrix %g' % abs(m - synthetic/synthetic[2,2]).max()
+        if m is not None:
             print 'Saving matrix to %s.npy\n %s' % (matrix_file, repr(m))
             numpy.save(matrix_file,m)
     else:
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import csv
+import json
+import time
+import threading
+import collections
+import numpy
+
+class NullProfiler(object):
+    """Does nothing, so instrumented code costs next to nothing when profiling is off"""
+
+    enabled = False
+
+    def begin(self):
+        return 0
+
+    def end(self, stage, start):
+        return 0
+
+    def frame(self, captured=None, dropped=0, shown=None):
+        pass
+
+class Profiler(NullProfiler):
+    """Per-stage timings over a rolling window of frames
+
+    begin() -- Return a start time for a stage
+    end(stage, start) -- Record how long a stage took since start, returning the end time
+    frame(captured, dropped, shown) -- Mark a frame as shown, captured at the given time
+    percentiles(stage) -- Return the p50, p95 and p99 of a stage in seconds
+    summary() -- Return lines of text describing the recent frames
+    save(filename) -- Write the per-frame trace as .json or .csv
+
+    Stages can be timed from several threads.  Only frames showing a new
+    capture count, the timings of any other display updates go to the
+    next one that does.
+    """
+
+    enabled = True
+
+    def __init__(self, window=300, trace_size=100000):
+        self.window = window
+        self.stages = collections.OrderedDict()
+        self.frame_times = collections.deque(maxlen=window)
+        self.latencies = collections.deque(maxlen=window)
+        self.dropped = 0
+        # the stage timings of each frame, for exporting
+        self.current = {}
+        self.trace = collections.deque(maxlen=trace_size)
+        self.last_captured = None
+        self.lock = threading.Lock()
+
+    def begin(self):
+        return time.time()
+
+    def end(self, stage, start):
+        now = time.time()
+        elapsed = now - start
+        with self.lock:
+            if stage not in self.stages:
+                self.stages[stage] = collections.deque(maxlen=self.window)
+            self.stages[stage].append(elapsed)
+            self.current[stage] = self.current.get(stage, 0.0) + elapsed
+        return now
+
+    def frame(self, captured=None, dropped=0, shown=None):
+        now = time.time()
+        # the latency is measured on the clock captured came from, if it isn't
+        # the wall clock, e.g. when replaying
+        if shown is None:
+            shown = now
+        self.dropped = dropped
+        # nothing new was captured, so this isn't a new frame
+        if captured is None or captured == self.last_captured:
+            return
+        self.last_captured = captured
+        self.frame_times.append(now)
+        with self.lock:
+            row = self.current
+            self.current = {}
+        row['time'] = now
+        row['dropped'] = dropped
+        # motion to photon, as far as we can see it: camera capture to flip
+        self.latencies.append(shown - captured)
+        row['latency'] = shown - captured
+        self.trace.append(row)
+
+    def fps(self):
+        if len(self.frame_times) < 2:
+            return 0.0
+        return (len(self.frame_times) - 1)/(self.frame_times[-1] - self.frame_times[0])
+
+    def percentiles(self, stage):
+        if stage == 'latency':
+            samples = self.latencies
+        else:
+            samples = self.stages.get(stage, [])
+        if len(samples) == 0:
+            return (0.0, 0.0, 0.0)
+        return tuple(numpy.percentile(numpy.array(samples), [50, 95, 99]))
+
+    def summary(self):
+        lines = ['%.1f fps, %d dropped frames' % (self.fps(), self.dropped),
+                 '%-10s %7s %7s %7s' % ('ms', 'p50', 'p95', 'p99')]
+        for stage in list(self.stages.keys()) + ['latency']:
+            p = self.percentiles(stage)
+            lines.append('%-10s %7.2f %7.2f %7.2f' % (stage, p[0]*1000.0, p[1]*1000.0, p[2]*1000.0))
+        return lines
+
+    def save(self, filename):
+        rows = list(self.trace)
+        if filename.endswith('.json'):
+            f = open(filename, 'w')
+            json.dump(rows, f)
+            f.close()
+            return
+        columns = ['time', 'dropped', 'latency'] + list(self.stages.keys())
+        f = open(filename, 'wb')
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([row.get(c, '') for c in columns])
+        f.close()
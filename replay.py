@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import struct
+import numpy
+import pygame
+
+FRAME_MAGIC = 'ACFR'
+PACKET_MAGIC = 'ACPK'
+FRAME_HEADER = struct.Struct('<4sII')
+PACKET_HEADER = struct.Struct('<dI')
+
+def packet_log_name(name, index=0):
+    # the first device's log is name.packets, any others are numbered
+    if index == 0:
+        return name + '.packets'
+    return '%s.%d.packets' % (name, index)
+
+def frame_dtype(resolution):
+    # one fixed size record per frame, so the file can be memory-mapped
+    return numpy.dtype([('time', '<f8'), ('pixels', 'u1', (resolution[0], resolution[1], 3))])
+
+class ReplayClock(object):
+    """Shared time base for replaying frames and serial bytes together
+
+    In realtime mode it follows the wall clock from the first recorded
+    timestamp.  Otherwise it only moves when the replayed camera delivers
+    a frame, so replays are deterministic and as fast as the reader.
+    """
+
+    def __init__(self, realtime=False):
+        self.realtime = realtime
+        self.base = None
+        self.start = None
+        self.time = None
+
+    def sync(self, t):
+        if self.base is None:
+            self.base = t
+            self.start = time.time()
+
+    def advance(self, t):
+        self.sync(t)
+        if self.realtime:
+            delay = (t - self.base) - (time.time() - self.start)
+            if delay > 0:
+                time.sleep(delay)
+        self.time = t
+
+    def now(self):
+        if self.realtime and self.base is not None:
+            return self.base + time.time() - self.start
+        return self.time
+
+class FrameRecorder(object):
+    """Appends timestamped camera frames to a raw frame file"""
+
+    def __init__(self, filename, resolution):
+        self.file = open(filename, 'wb')
+        self.file.write(FRAME_HEADER.pack(FRAME_MAGIC, resolution[0], resolution[1]))
+        self.record = numpy.zeros(1, frame_dtype(resolution))
+
+    def write(self, surface, t=None):
+        if t is None:
+            t = time.time()
+        self.record['time'] = t
+        self.record['pixels'][0] = pygame.surfarray.array3d(surface)
+        self.file.write(self.record.tostring())
+
+    def close(self):
+        self.file.close()
+
+class PacketRecorder(object):
+    """Appends timestamped chunks of raw serial bytes to a packet log"""
+
+    def __init__(self, filename):
+        self.file = open(filename, 'wb')
+        self.file.write(PACKET_MAGIC)
+
+    def write(self, data, t=None):
+        if t is None:
+            t = time.time()
+        self.file.write(PACKET_HEADER.pack(t, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+class RecordingCamera(object):
+    """Wraps a pygame.camera.Camera, recording every frame it returns"""
+
+    def __init__(self, camera, filename):
+        self.camera = camera
+        self.filename = filename
+        self.recorder = None
+
+    def start(self):
+        self.camera.start()
+        # the actual size is only known once the camera has started
+        self.recorder = FrameRecorder(self.filename, self.camera.get_size())
+
+    def stop(self):
+        self.camera.stop()
+        self.recorder.close()
+
+    def get_size(self):
+        return self.camera.get_size()
+
+    def get_image(self, surface=None):
+        if surface is None:
+            surface = self.camera.get_image()
+        else:
+            surface = self.camera.get_image(surface)
+        self.recorder.write(surface)
+        return surface
+
+class RecordingSerial(object):
+    """Wraps a serial.Serial, recording every chunk of bytes read from it"""
+
+    def __init__(self, ser, filename):
+        self.ser = ser
+        self.recorder = PacketRecorder(filename)
+
+    def get_timeout(self):
+        return self.ser.timeout
+
+    def set_timeout(self, timeout):
+        self.ser.timeout = timeout
+
+    timeout = property(get_timeout, set_timeout)
+
+    def flushInput(self):
+        self.ser.flushInput()
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if len(data):
+            self.recorder.write(data)
+        return data
+
+    def write(self, data):
+        return self.ser.write(data)
+
+    def close(self):
+        self.ser.close()
+        self.recorder.close()
+
+class ReplayCamera(object):
+    """Plays back a raw frame file in place of a pygame.camera.Camera
+
+    now() -- Return the time on the replay clock, for timing the frames
+    finished -- True once every frame has been returned
+    """
+
+    def __init__(self, filename, clock=None, loop=False):
+        f = open(filename, 'rb')
+        magic, width, height = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+        f.close()
+        if magic != FRAME_MAGIC:
+            raise IOError('%s is not a recorded frame file' % filename)
+        self.resolution = (width, height)
+        self.frames = numpy.memmap(filename, frame_dtype(self.resolution), 'r', FRAME_HEADER.size)
+        self.clock = clock
+        if self.clock is None:
+            self.clock = ReplayClock()
+        self.loop = loop
+        self.index = 0
+        self.finished = False
+        self.converted = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def start(self):
+        self.index = 0
+        self.finished = False
+
+    def stop(self):
+        pass
+
+    def get_size(self):
+        return self.resolution
+
+    def now(self):
+        """Return the time on the replay clock, for timing the frames"""
+        t = self.clock.now()
+        if t is None:
+            # nothing has been played yet
+            t = float(self.frames[0]['time'])
+        return t
+
+    def get_image(self, surface=None):
+        if self.index >= len(self.frames):
+            if self.loop:
+                self.index = 0
+            else:
+                # keep showing the last frame
+                self.finished = True
+                self.index = len(self.frames) - 1
+        frame = self.frames[self.index]
+        self.index += 1
+
+        self.clock.advance(float(frame['time']))
+        if surface is None:
+            surface = pygame.surface.Surface(self.resolution, 0, 24)
+        if surface.get_bitsize() in (24, 32):
+            pygame.surfarray.blit_array(surface, frame['pixels'])
+        else:
+            # e.g. the 8 bit display depth a headless pygame 1.9 gives, which
+            # blit_array can't take 24 bit pixels into, so convert with a blit
+            if self.converted is None:
+                self.converted = pygame.surface.Surface(self.resolution, 0, 24)
+            pygame.surfarray.blit_array(self.converted, frame['pixels'])
+            surface.blit(self.converted, (0, 0))
+        return surface
+
+class ReplaySerial(object):
+    """Plays back a packet log in place of a serial.Serial
+
+    Bytes become readable once the clock reaches the time they were
+    recorded.  Anything written is kept in written.
+    """
+
+    def __init__(self, filename, clock=None):
+        self.clock = clock
+        if self.clock is None:
+            self.clock = ReplayClock()
+        self.chunks = []
+        f = open(filename, 'rb')
+        if f.read(len(PACKET_MAGIC)) != PACKET_MAGIC:
+            raise IOError('%s is not a recorded packet log' % filename)
+        while True:
+            header = f.read(PACKET_HEADER.size)
+            if len(header) < PACKET_HEADER.size:
+                break
+            t, length = PACKET_HEADER.unpack(header)
+            self.chunks.append((t, f.read(length)))
+        f.close()
+        self.index = 0
+        self.pending = ''
+        self.written = []
+        self.timeout = 0
+
+    def flushInput(self):
+        pass
+
+    def read(self, size=1):
+        now = self.clock.now()
+        while self.index < len(self.chunks) and now is not None and self.chunks[self.index][0] <= now:
+            self.pending += self.chunks[self.index][1]
+            self.index += 1
+        data = self.pending[0:size]
+        self.pending = self.pending[size:]
+        if len(data) == 0 and self.timeout:
+            # behave like a blocking read that timed out
+            time.sleep(self.timeout)
+        return data
+
+    def write(self, data):
+        self.written.append(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+if __name__ == '__main__':
+    # print a summary of a recording
+    if len(sys.argv) < 2:
+        print 'Usage: python replay.py recording'
+        sys.exit(2)
+    camera = ReplayCamera(sys.argv[1] + '.frames')
+    times = camera.frames['time']
+    print '%d frames of %dx%d over %.1f seconds' % ((len(camera),) + camera.resolution + (times[-1]-times[0],))
+    ser = ReplaySerial(packet_log_name(sys.argv[1]))
+    print '%d serial chunks, %d bytes' % (len(ser.chunks), sum([len(c[1]) for c in ser.chunks]))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import numpy
+import numpy.lib.format
+import pygame
+
+def set_aside_name(filename):
+    # the first free name like canvas.old.npy, canvas.old1.npy, ...
+    base, ext = os.path.splitext(filename)
+    name = '%s.old%s' % (base, ext)
+    i = 1
+    while os.path.exists(name):
+        name = '%s.old%d%s' % (base, i, ext)
+        i += 1
+    return name
+
+class TileStore(object):
+    """Keeps a copy of a drawing on disk, written a tile at a time
+
+    mark(rect) -- Note that part of the drawing has changed
+    save(surface) -- Queue the changed tiles to be written in the background
+    load(surface) -- Copy the saved drawing into a surface, if there is one
+    close() -- Write out anything still queued and stop
+
+    The drawing lives in a memory-mapped .npy file, so only the tiles
+    that changed are ever written, and reloading it is a single copy.
+    """
+
+    def __init__(self, filename, resolution, tile_size=128):
+        self.filename = filename
+        self.resolution = resolution
+        self.tile_size = tile_size
+        shape = (resolution[0], resolution[1], 3)
+
+        # reuse the last session's drawing if it is the same size, otherwise
+        # move it out of the way rather than drawing over it
+        self.loaded = False
+        if os.path.exists(filename):
+            self.pixels = numpy.lib.format.open_memmap(filename, 'r+')
+            if self.pixels.shape == shape and self.pixels.dtype == numpy.uint8:
+                self.loaded = True
+            else:
+                del self.pixels
+                aside = set_aside_name(filename)
+                os.rename(filename, aside)
+                print 'Saved canvas %s is the wrong size, moved it to %s and started a new one' % (filename, aside)
+        if not self.loaded:
+            self.pixels = numpy.lib.format.open_memmap(filename, 'w+', numpy.uint8, shape)
+
+        self.dirty = set()
+        # tile -> latest copy of its pixels not yet written
+        self.pending = {}
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.writer_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def mark(self, rect):
+        """Note that part of the drawing has changed"""
+        rect = pygame.Rect(rect).clip(pygame.Rect((0, 0), self.resolution))
+        if rect.width == 0 or rect.height == 0:
+            return
+        s = self.tile_size
+        for tx in range(rect.left/s, (rect.right-1)/s + 1):
+            for ty in range(rect.top/s, (rect.bottom-1)/s + 1):
+                self.dirty.add((tx, ty))
+
+    def save(self, surface):
+        """Queue the changed tiles to be written in the background"""
+        if len(self.dirty) == 0:
+            return
+        # copying a few tiles is cheap, so the render loop never waits on the disk
+        s = self.tile_size
+        view = pygame.surfarray.pixels3d(surface)
+        copies = dict([((tx, ty), view[tx*s:(tx+1)*s, ty*s:(ty+1)*s].copy()) for tx, ty in self.dirty])
+        del view
+        self.dirty = set()
+        with self.cond:
+            self.pending.update(copies)
+            self.cond.notify()
+
+    def load(self, surface):
+        """Copy the saved drawing into a surface, if there is one"""
+        if self.loaded:
+            pygame.surfarray.blit_array(surface, self.pixels)
+        return self.loaded
+
+    def writer_loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait(0.5)
+                if not self.running and not self.pending:
+                    break
+                pending = self.pending
+                self.pending = {}
+            s = self.tile_size
+            for (tx, ty), pixels in pending.items():
+                self.pixels[tx*s:tx*s+pixels.shape[0], ty*s:ty*s+pixels.shape[1]] = pixels
+            self.pixels.flush()
+
+    def close(self):
+        """Write out anything still queued and stop"""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join()
+        del self.pixels
@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 
 import sys
+import time
 import serial
 import struct
+import threading
+import collections
 
 PACKET_QUAT = 0
 PACKET_ACC = 1
@@ -22,76 +25,214 @@ PACKET_GPIO_PORT = 14
 PACKET_POWER = 15
 PACKET_MAX = 16
 
+# one record type per kind of packet, all starting with the packet type
+Quaternion = collections.namedtuple('Quaternion', 'type w x y z')
+Vector = collections.namedtuple('Vector', 'type x y z')
+Color = collections.namedtuple('Color', 'type r g b')
+Value = collections.namedtuple('Value', 'type value')
+Calibration = collections.namedtuple('Calibration', 'type ox oy oz sx sy sz')
+
+# precompiled parsers, indexed by packet type
+PACKET_PARSERS = [None]*PACKET_MAX
+PACKET_PARSERS[PACKET_QUAT] = (struct.Struct('!Bffff'), Quaternion)
+PACKET_PARSERS[PACKET_ACC] = (struct.Struct('!Bhhh'), Vector)
+PACKET_PARSERS[PACKET_GYRO] = (struct.Struct('!Bhhh'), Vector)
+PACKET_PARSERS[PACKET_MAG] = (struct.Struct('!Bhhh'), Vector)
+PACKET_PARSERS[PACKET_TEMPERATURE] = (struct.Struct('!Bh'), Value)
+PACKET_PARSERS[PACKET_GPIO] = (struct.Struct('!BB'), Value)
+PACKET_PARSERS[PACKET_COLOR] = (struct.Struct('!BBBB'), Color)
+PACKET_PARSERS[PACKET_BLINK] = (struct.Struct('!BBBB'), Color)
+PACKET_PARSERS[PACKET_IR] = (struct.Struct('!BB'), Value)
+PACKET_PARSERS[PACKET_STREAM] = (struct.Struct('!BB'), Value)
+PACKET_PARSERS[PACKET_VERSION] = (struct.Struct('!BI'), Value)
+PACKET_PARSERS[PACKET_ID] = (struct.Struct('!BI'), Value)
+PACKET_PARSERS[PACKET_CAL] = (struct.Struct('!Bffffff'), Calibration)
+PACKET_PARSERS[PACKET_GPIO_DDR] = (struct.Struct('!BB'), Value)
+PACKET_PARSERS[PACKET_GPIO_PORT] = (struct.Struct('!BB'), Value)
+PACKET_PARSERS[PACKET_POWER] = (struct.Struct('!BB'), Value)
+
+def open_serial(port):
+    ser = serial.Serial(port, 38400, timeout=0)
+    ser.open()
+    return ser
+
 class Tracker(object):
-    def __init__(self, port):
+    def __init__(self, port, threaded=False, ring_size=256, ser=None):
         self.END = chr(0xC0)
         self.ESC = chr(0xDB)
         self.ESC_END = chr(0xDC)
         self.ESC_ESC = chr(0xDD)
-        self.ser = serial.Serial(port, 38400, timeout=0)
-        self.ser.open()
+        # an already open serial-like object can be passed in instead of a port
+        self.ser = ser
+        if self.ser is None:
+            self.ser = open_serial(port)
         self.ser.flushInput()
-        self.read_buf = []
+        # undecoded bytes carried over between reads, reused to avoid reallocating
+        self.read_buf = bytearray()
+        # state for the older per character decoder
+        self.char_buf = []
         self.escaping = False
+        
+        # in threaded mode, reads and writes happen off the caller's thread
+        self.threaded = threaded
+        self.running = False
+        self.threads = []
+        self.ring = collections.deque(maxlen=ring_size)
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.pending_order = []
+        # packets taken off pending but not yet written out
+        self.writing = 0
+        if threaded:
+            # let the reader block briefly instead of spinning
+            self.ser.timeout = 0.05
+            self.running = True
+            self.threads = [threading.Thread(target=self.reader_loop),
+                            threading.Thread(target=self.writer_loop)]
+            for thread in self.threads:
+                thread.daemon = True
+                thread.start()
     
-    def parse_packet(self, packet):
-        t = ord(packet[0])
-    
-        try:
-            if t == PACKET_QUAT:
-                return struct.unpack('!Bffff', packet)
-            elif t == PACKET_ACC or t == PACKET_GYRO or t == PACKET_MAG:
-                return struct.unpack('!Bhhh', packet)
-            elif t == PACKET_COLOR or t == PACKET_BLINK:
-                return struct.unpack('!BBBB', packet)
-            elif t == PACKET_GPIO or t == PACKET_IR:
-                return struct.unpack('!BB', packet)
-            elif t == PACKET_VERSION or t == PACKET_ID:
-                return struct.unpack('!BI', packet)
-            else:
-                print "Unknown packet type %d" % t
-                return None
-        except struct.error as ex:
-            print "Failed to parse packet:", ex
-            
-        return None
+    def parse_packet(self, packet, offset=0, length=None):
+        # parse in place, so a packet can be read straight out of a larger buffer
+        if length is None:
+            length = len(packet) - offset
+        t = packet[offset]
+        if not isinstance(t, int):
+            t = ord(t)
+        
+        parser = None
+        if t < PACKET_MAX:
+            parser = PACKET_PARSERS[t]
+        if parser is None:
+            print "Unknown packet type %d" % t
+            return None
+        
+        s, record = parser
+        if s.size != length:
+            print "Failed to parse packet: type %d needs %d bytes, got %d" % (t, s.size, length)
+            return None
+        return record._make(s.unpack_from(packet, offset))
             
     def read_char(self, c):
-        if c == self.END and len(self.read_buf) != 0:
+        if c == self.END and len(self.char_buf) != 0:
             self.escaping = False
             return 1
         elif c == self.ESC:
             self.escaping = True
         elif c == self.ESC_END:
             if self.escaping:
-                self.read_buf.append(self.END)
+                self.char_buf.append(self.END)
                 self.escaping = False
             else:
-                self.read_buf.append(c)
+                self.char_buf.append(c)
         elif c == self.ESC_ESC:
             if self.escaping:
-                self.read_buf.append(self.ESC)
+                self.char_buf.append(self.ESC)
                 self.escaping = False
             else:
-                self.read_buf.append(c)
+                self.char_buf.append(c)
         else:
-            self.read_buf.append(c)
+            self.char_buf.append(c)
                 
         return 0
         
+    def decode_chars(self, characters):
+        # the original per character decoder, kept for comparison
+        packets = []
+        for c in characters:
+            if self.read_char(c):
+                packet = self.parse_packet(''.join(self.char_buf))
+                if packet:
+                    packets.append(packet)
+                self.char_buf = []
+        return packets
+        
+    def unescape(self, frame):
+        # a dropped ESC leaves the next byte as is, like read_char does
+        parts = frame.split(self.ESC)
+        unescaped = parts[0]
+        for part in parts[1:]:
+            if part[0:1] == self.ESC_END:
+                unescaped += self.END + part[1:]
+            elif part[0:1] == self.ESC_ESC:
+                unescaped += self.ESC + part[1:]
+            else:
+                unescaped += part
+        return unescaped
+        
+    def decode(self, characters):
+        buf = self.read_buf
+        buf.extend(characters)
+        packets = []
+        
+        # split whole frames off the buffer, leaving any partial frame behind
+        start = 0
+        while True:
+            end = buf.find(self.END, start)
+            if end < 0:
+                break
+            if end > start:
+                if buf.find(self.ESC, start, end) >= 0:
+                    packet = self.parse_packet(self.unescape(buf[start:end]))
+                else:
+                    packet = self.parse_packet(buf, start, end - start)
+                if packet:
+                    packets.append(packet)
+            start = end + 1
+        del buf[0:start]
+        return packets
+        
+    def reader_loop(self):
+        while self.running:
+            characters = self.ser.read(1024)
+            if len(characters):
+                now = time.time()
+                for packet in self.decode(characters):
+                    self.ring.append((now, packet))
+                    
+    def writer_loop(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending_order:
+                    self.cond.wait(0.1)
+                if not self.running and not self.pending_order:
+                    break
+                # only the latest command of each type is still pending
+                packets = [self.pending[t] for t in self.pending_order]
+                self.pending = {}
+                self.pending_order = []
+                self.writing = len(packets)
+            for packet in packets:
+                self.ser.write(self.encode(packet))
+            with self.cond:
+                self.writing = 0
+                self.cond.notify_all()
+        
+    def read_timestamped_packets(self):
+        if not self.threaded:
+            now = time.time()
+            return [(now, packet) for packet in self.read_packets()]
+        
+        packets = []
+        while True:
+            try:
+                packets.append(self.ring.popleft())
+            except IndexError:
+                break
+        return packets
+        
     def read_packets(self):
+        if self.threaded:
+            return [packet for t, packet in self.read_timestamped_packets()]
+        
         packets = []
         characters = self.ser.read(1024)
         if len(characters):
-            for c in characters:
-                if self.read_char(c):
-                    packet = self.parse_packet(''.join(self.read_buf))
-                    if packet:
-                        packets.append(packet)
-                    self.read_buf = []
+            packets = self.decode(characters)
         return packets
         
-    def write_packet(self, packet):
+    def encode(self, packet):
         slipped = [];
         
         for c in packet:
@@ -105,7 +246,33 @@ class Tracker(object):
                 slipped.append(c)
                 
         slipped.append(self.END)
-        self.ser.write(''.join(slipped))
+        return ''.join(slipped)
+        
+    def write_packet(self, packet):
+        if not self.threaded:
+            self.ser.write(self.encode(packet))
+            return
+        
+        # coalesce with any unsent command of the same type
+        t = ord(packet[0])
+        with self.cond:
+            if t not in self.pending:
+                self.pending_order.append(t)
+            self.pending[t] = packet
+            self.cond.notify_all()
+            
+    def flush(self, timeout=1.0):
+        """Wait until every command so far has been written, return False on timeout"""
+        if not self.threaded:
+            return True
+        end = time.time() + timeout
+        with self.cond:
+            while self.pending_order or self.writing:
+                left = end - time.time()
+                if left <= 0 or not self.threads:
+                    return False
+                self.cond.wait(left)
+        return True
         
     def set_color(self, rgb):
         packed = struct.pack('!BBBB', PACKET_COLOR, rgb[0], rgb[1], rgb[2])
@@ -138,6 +305,13 @@ class Tracker(object):
         self.write_packet(packed)
         
     def close(self):
+        # the writer flushes whatever is still pending before it exits
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
         self.ser.close()
 
 if __name__ == '__main__':
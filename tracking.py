@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import itertools
+import numpy
+
+class AlphaBetaFilter(object):
+    """Smooths a moving 2D point and estimates its velocity
+
+    update(point, t) -- Fold in a measurement taken at time t
+    predict(t) -- Return where the point is expected to be at time t
+    reset() -- Forget the point, e.g. when its blob is lost
+
+    alpha is how much of each position error to believe, beta how much of
+    it to put into the velocity.  Lower values smooth more but lag more.
+    """
+
+    def __init__(self, alpha=0.7, beta=0.3):
+        self.alpha = alpha
+        self.beta = beta
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self.position = None
+        self.velocity = (0.0, 0.0)
+        self.time = None
+
+    def predict(self, t):
+        if not self.active:
+            return None
+        dt = t - self.time
+        return (self.position[0] + self.velocity[0]*dt, self.position[1] + self.velocity[1]*dt)
+
+    def update(self, point, t):
+        if not self.active:
+            self.active = True
+            self.position = (float(point[0]), float(point[1]))
+            self.velocity = (0.0, 0.0)
+            self.time = t
+            return self.position
+
+        dt = t - self.time
+        if dt <= 0:
+            # same frame again, just nudge the position
+            dt = 0
+        p = self.predict(t)
+        r = (point[0] - p[0], point[1] - p[1])
+        self.position = (p[0] + self.alpha*r[0], p[1] + self.alpha*r[1])
+        if dt > 0:
+            self.velocity = (self.velocity[0] + self.beta*r[0]/dt, self.velocity[1] + self.beta*r[1]/dt)
+        self.time = t
+        return self.position
+
+class HomographyRLS(object):
+    """Keeps refining a homography from a stream of matched points
+    
+    update(source, target) -- Fold in a source point seen to map to target
+    matrix() -- Return the current 3x3 homography
+    
+    A recursive least squares estimate of the 8 free parameters, worked
+    in coordinates scaled to about 0..1 to keep it well conditioned.
+    forget below 1 lets old pairs fade so the estimate can follow a drift,
+    and a smaller confidence trusts the starting matrix more.  With the
+    default of 1 a bumped camera is followed within a few frames of the
+    corners; at 1e-4 it takes a few hundred.
+    """
+    
+    def __init__(self, matrix, source_res, target_res, forget=0.995, confidence=1.0):
+        self.scale = numpy.diag([1.0/source_res[0], 1.0/source_res[1], 1.0])
+        self.target_scale = numpy.diag([1.0/target_res[0], 1.0/target_res[1], 1.0])
+        m = numpy.dot(self.target_scale, numpy.dot(matrix, numpy.linalg.inv(self.scale)))
+        self.theta = (m/m[2, 2]).ravel()[0:8]
+        self.P = numpy.eye(8)*confidence
+        self.forget = forget
+        
+    def update(self, source, target):
+        x = source[0]*self.scale[0, 0]
+        y = source[1]*self.scale[1, 1]
+        u = target[0]*self.target_scale[0, 0]
+        v = target[1]*self.target_scale[1, 1]
+        # u*(h31*x + h32*y + 1) = h11*x + h12*y + h13, and the same for v
+        rows = ((numpy.array([x, y, 1, 0, 0, 0, -x*u, -y*u]), u),
+                (numpy.array([0, 0, 0, x, y, 1, -x*v, -y*v]), v))
+        for a, b in rows:
+            Pa = numpy.dot(self.P, a)
+            k = Pa/(self.forget + numpy.dot(a, Pa))
+            self.theta = self.theta + k*(b - numpy.dot(a, self.theta))
+            self.P = (self.P - numpy.outer(k, Pa))/self.forget
+            
+    def matrix(self):
+        m = numpy.append(self.theta, 1.0).reshape(3, 3)
+        return numpy.dot(numpy.linalg.inv(self.target_scale), numpy.dot(m, self.scale))
+
+def triangle_area(a, b, c):
+    # twice the signed area, positive when a, b, c go one way round
+    return a[0]*b[1] - a[1]*b[0] + b[0]*c[1] - b[1]*c[0] + c[0]*a[1] - c[1]*a[0]
+
+def order_quad(points):
+    """Return 4 points reordered to go round the quadrilateral"""
+    p = list(points)
+    # quadrilateral ordering from http://stackoverflow.com/a/246063
+    abc = triangle_area(p[0], p[1], p[2])
+    acd = triangle_area(p[0], p[2], p[3])
+    
+    if abc < 0:
+        if acd >= 0:
+            if triangle_area(p[0], p[1], p[3]) < 0:
+                p[2], p[3] = p[3], p[2]
+            else:
+                p[0], p[3] = p[3], p[0]
+    elif acd < 0:
+        if triangle_area(p[0], p[1], p[3]) < 0:
+            p[1], p[2] = p[2], p[1]
+        else:
+            p[0], p[1] = p[1], p[0]
+    else:
+        p[0], p[2] = p[2], p[0]
+    return p
+
+class CanvasQuad(object):
+    """Where the canvas corners are, in order round the canvas
+    
+    version goes up by one whenever the points change, so anything drawn
+    from them only needs redoing when it differs from what was drawn.
+    """
+    
+    def __init__(self):
+        self.points = []
+        self.version = 0
+        
+    def set(self, points):
+        self.points = points
+        self.version += 1
+
+class CornerTracker(object):
+    """Follows the 4 canvas corners from frame to frame
+    
+    update(points) -- Fold in this frame's corners, return True if the quad moved
+    reset() -- Forget the corners, e.g. when the canvas is lost
+    
+    Each corner is matched to the nearest one of the last frame, so the
+    order only has to be worked out from scratch when the canvas first
+    shows up or jumps by more than max_jump.  Moves under tolerance
+    pixels are put down to noise and leave the quad alone.
+    """
+    
+    def __init__(self, tolerance=2.0, max_jump=80.0):
+        self.tolerance = tolerance
+        self.max_jump = max_jump
+        self.quad = CanvasQuad()
+        
+    def reset(self):
+        if len(self.quad.points):
+            self.quad.set([])
+        
+    def update(self, points):
+        if len(self.quad.points) != 4:
+            self.quad.set(order_quad(points))
+            return True
+        
+        # the pairing with the last corners that moves them the least, out of
+        # only 24, keeps the corners in the same order round the canvas
+        old = numpy.array(self.quad.points, dtype=float)
+        new = numpy.array(points, dtype=float)
+        d = numpy.sqrt(((old[:, None, :] - new[None, :, :])**2).sum(axis=2))
+        best = min(itertools.permutations(range(0, 4)), key=lambda p: d[range(0, 4), p].sum())
+        moved = d[range(0, 4), best]
+        if moved.max() > self.max_jump:
+            self.quad.set(order_quad(points))
+            return True
+        if moved.max() < self.tolerance:
+            return False
+        self.quad.set([points[i] for i in best])
+        return True
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import time
+import ctypes
+import multiprocessing
+import numpy
+import pygame
+import blobs
+
+class FrameRing(object):
+    """Camera frames shared with another process through shared memory
+
+    put(surface, t) -- Copy a frame into the next slot
+    read(surface, after) -- Copy out the newest frame if it is newer than after
+
+    Frames are copied straight into the shared buffer, never pickled.  The
+    writer goes round the slots, so a reader that falls behind only ever
+    skips frames, and a slot overwritten while it was read is noticed.
+    """
+
+    def __init__(self, resolution, slots=4):
+        self.resolution = resolution
+        self.slots = slots
+        size = resolution[0]*resolution[1]*3
+        self.buffer = multiprocessing.RawArray(ctypes.c_uint8, slots*size)
+        self.times = multiprocessing.RawArray(ctypes.c_double, slots)
+        # the number of the frame in each slot, -1 while it is written
+        self.frames = multiprocessing.RawArray(ctypes.c_long, [-1]*slots)
+        self.count = multiprocessing.RawValue(ctypes.c_long, 0)
+        self.pixels = numpy.frombuffer(self.buffer, numpy.uint8).reshape(slots, resolution[0], resolution[1], 3)
+
+    def put(self, surface, t):
+        """Copy a frame into the next slot"""
+        n = self.count.value
+        slot = n % self.slots
+        self.frames[slot] = -1
+        view = pygame.surfarray.pixels3d(surface)
+        self.pixels[slot] = view
+        del view
+        self.times[slot] = t
+        self.frames[slot] = n
+        self.count.value = n + 1
+
+    def read(self, surface, after=-1):
+        """Copy out the newest frame if it is newer than after
+
+        Returns (frame number, time), or None if there is nothing new.
+        """
+        n = self.count.value - 1
+        if n <= after:
+            return None
+        slot = n % self.slots
+        t = self.times[slot]
+        pygame.surfarray.blit_array(surface, self.pixels[slot])
+        # the writer lapped us while we copied
+        if self.frames[slot] != n:
+            return None
+        return (n, t)
+
+def result_dtype(max_blobs, max_outline):
+    blob = numpy.dtype([('count', '<i4'), ('centroid', '<f8', (2,)), ('points', '<i4'),
+                        ('outline', '<i2', (max_outline, 2))])
+    return numpy.dtype([('seq', '<i8'), ('frame', '<i8'), ('time', '<f8'), ('n', '<i4'),
+                        ('blobs', blob, (max_blobs,))])
+
+class SharedBlob(object):
+    """A blob read back from BlobResults, with the methods of a pygame.mask.Mask component"""
+
+    def __init__(self, record):
+        self.area = int(record['count'])
+        self.center = tuple(record['centroid'].tolist())
+        self.points = record['outline'][0:record['points']]
+
+    def count(self):
+        return self.area
+
+    def centroid(self):
+        return self.center
+
+    def outline(self, every=1):
+        return [tuple(p) for p in self.points[::every].tolist()]
+
+    def get_bounding_rects(self):
+        lo = self.points.min(axis=0)
+        hi = self.points.max(axis=0)
+        return [pygame.Rect(int(lo[0]), int(lo[1]), int(hi[0]-lo[0])+1, int(hi[1]-lo[1])+1)]
+
+class BlobResults(object):
+    """The blobs found in the latest frame, shared with another process
+
+    write(frame, t, ccs) -- Publish the blobs found in a frame
+    read() -- Return (frame, time, blobs) from a consistent copy
+
+    One structured record in shared memory, guarded by a sequence number
+    that is odd while it is written, so neither side ever takes a lock.
+    Outlines longer than max_outline points are thinned out to fit.
+    """
+
+    def __init__(self, max_blobs=16, max_outline=256):
+        self.max_blobs = max_blobs
+        self.max_outline = max_outline
+        dtype = result_dtype(max_blobs, max_outline)
+        self.buffer = multiprocessing.RawArray(ctypes.c_uint8, dtype.itemsize)
+        self.record = numpy.frombuffer(self.buffer, dtype, 1)
+        self.record['frame'] = -1
+
+    def write(self, frame, t, ccs):
+        """Publish the blobs found in a frame"""
+        record = self.record
+        record['seq'] += 1
+        # keep the largest, the same as AdjacentCanvas.find_blobs
+        ccs = blobs.largest_blobs(ccs, self.max_blobs)
+        found = record['blobs'][0]
+        for i, cc in enumerate(ccs):
+            outline = cc.outline(1)
+            every = (len(outline) + self.max_outline - 1)/self.max_outline
+            if every > 1:
+                outline = outline[::every]
+            found['count'][i] = cc.count()
+            found['centroid'][i] = cc.centroid()
+            found['points'][i] = len(outline)
+            if len(outline):
+                found['outline'][i, 0:len(outline)] = outline
+        record['n'] = len(ccs)
+        record['frame'] = frame
+        record['time'] = t
+        record['seq'] += 1
+
+    def read(self):
+        """Return (frame, time, blobs) from a consistent copy"""
+        while True:
+            seq = int(self.record[0]['seq'])
+            if seq % 2 == 0:
+                r = self.record[0].copy()
+                if int(self.record[0]['seq']) == seq:
+                    break
+            # caught it mid-write, which only lasts a moment
+            time.sleep(0)
+        found = [SharedBlob(b) for b in r['blobs'][0:r['n']]]
+        return (int(r['frame']), float(r['time']), found)
+
+def worker_loop(ring, results, threshold, running, backend, min_size, decimate):
+    detector = blobs.get_detector(backend, decimate)
+    surface = pygame.surface.Surface(ring.resolution, 0, 24)
+    last = -1
+    while running.value:
+        frame = ring.read(surface, last)
+        if frame is None:
+            time.sleep(0.001)
+            continue
+        last, t = frame
+        ccs = detector.detect(surface, threshold.value, min_size)
+        results.write(last, t, ccs)
+
+class TrackingProcess(object):
+    """Thresholds and finds blobs in camera frames on a process of its own
+
+    put(surface, t) -- Hand over a camera frame
+    get(timeout) -- Wait for the blobs from a newer frame, return (time, blobs) or None
+    start() -- Start the process
+    stop() -- Stop it and wait for it to finish
+
+    threshold is shared, set threshold.value to change it.  dropped counts
+    the frames the process never got to.  Only the max_blobs largest blobs
+    of each frame are handed back.  Start it before pygame.init(), so the
+    process doesn't inherit any SDL state.
+    """
+
+    def __init__(self, resolution, backend='pygame', min_size=100, slots=4, decimate=1, max_blobs=16):
+        self.ring = FrameRing(resolution, slots)
+        self.results = BlobResults(max_blobs)
+        self.threshold = multiprocessing.RawValue(ctypes.c_int, 100)
+        self.running = multiprocessing.RawValue(ctypes.c_int, 0)
+        self.backend = backend
+        self.min_size = min_size
+        self.decimate = decimate
+        self.process = None
+        self.last = -1
+        self.dropped = 0
+
+    def start(self):
+        self.running.value = 1
+        self.process = multiprocessing.Process(target=worker_loop,
+                                               args=(self.ring, self.results, self.threshold,
+                                                     self.running, self.backend, self.min_size,
+                                                     self.decimate))
+        self.process.daemon = True
+        self.process.start()
+
+    def stop(self):
+        self.running.value = 0
+        if self.process is not None:
+            self.process.join(1.0)
+            self.process = None
+
+    def put(self, surface, t):
+        """Hand over a camera frame"""
+        self.ring.put(surface, t)
+
+    def get(self, timeout=None):
+        """Wait for the blobs from a newer frame, return (time, blobs) or None"""
+        start = time.time()
+        while True:
+            frame, t, ccs = self.results.read()
+            if frame > self.last:
+                if self.last >= 0:
+                    self.dropped += frame - self.last - 1
+                self.last = frame
+                return (t, ccs)
+            if timeout is not None and time.time() - start >= timeout:
+                return None
+            time.sleep(0.001)